@@ -0,0 +1,202 @@
+"""
+Compares ctransformers and llama.cpp on the same GGUF models.
+
+Runs a fixed prompt set through each backend and each model in config.yaml, and reports
+load time, peak RSS, prompt and decode throughput and time to first token (TTFT). Each
+backend and model is measured in a fresh process, so that peak RSS is its own.
+
+With --tiny, Q2_K and Q4_K_M quantizations of TinyLlama are downloaded instead, so the
+suite runs on a CPU-only CI runner:
+
+    python -m benchmarks.backend_bench --tiny --num-prompts 2 --max-new-tokens 16
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+from datetime import datetime, timezone
+
+from loguru import logger
+
+from benchmarks.utils import get_commit
+from src import CFG
+from src.workers import available_cores
+
+BACKENDS = ("ctransformers", "llamacpp")
+DEFAULT_PROMPTS = "benchmarks/workloads/prompts.jsonl"
+TINY_MODEL_REPO = "TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF"
+TINY_MODEL_FILES = (
+    "tinyllama-1.1b-chat-v1.0.Q2_K.gguf",
+    "tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf",
+)
+MODEL_SECTIONS = ("LLAMA2", "CODELLAMA", "MISTRAL")
+
+
+def load_prompts(path: str) -> list[str]:
+    with open(path) as f:
+        return [json.loads(line)["prompt"] for line in f if line.strip()]
+
+
+def get_models(tiny: bool) -> list[str]:
+    if tiny:
+        from huggingface_hub import hf_hub_download
+
+        return [hf_hub_download(TINY_MODEL_REPO, filename) for filename in TINY_MODEL_FILES]
+    return [os.path.join(CFG.MODELS_DIR, CFG[section].MODEL_PATH) for section in MODEL_SECTIONS]
+
+
+def get_quantization(model_path: str) -> str:
+    """Quantization level in the file name, e.g. Q4_K_M."""
+    return os.path.basename(model_path).split(".")[-2]
+
+
+def load_model(
+    backend: str, model_path: str, context_length: int, threads: int, batch_size: int
+):
+    """Returns the model and its tokenize function, which return token ids. Both backends
+    evaluate the prompt in chunks of batch_size tokens; their defaults differ (8 and 512)."""
+    if backend == "ctransformers":
+        from ctransformers import AutoModelForCausalLM
+
+        llm = AutoModelForCausalLM.from_pretrained(
+            model_path, context_length=context_length, threads=threads, batch_size=batch_size
+        )
+        return llm, llm.tokenize
+
+    from llama_cpp import Llama
+
+    llm = Llama(
+        model_path,
+        n_ctx=context_length,
+        n_batch=batch_size,
+        n_threads=threads,
+        n_threads_batch=threads,
+        verbose=False,
+    )
+    return llm, lambda text: llm.tokenize(text.encode())
+
+
+def run_backend(
+    backend: str,
+    model_path: str,
+    prompts: list[str],
+    max_new_tokens: int,
+    context_length: int,
+    threads: int,
+    batch_size: int,
+) -> dict:
+    """Measures one backend and model. Runs in its own process."""
+    start = time.perf_counter()
+    llm, tokenize = load_model(backend, model_path, context_length, threads, batch_size)
+    load_seconds = time.perf_counter() - start
+
+    runs = []
+    for prompt in prompts:
+        tokens = tokenize(prompt)[: context_length - max_new_tokens]
+        # evaluate every prompt from scratch rather than reusing a common prefix
+        llm.reset()
+        n_generated, ttft = 0, None
+        start = time.perf_counter()
+        for _ in llm.generate(tokens):
+            n_generated += 1
+            if n_generated == 1:
+                ttft = time.perf_counter() - start
+            if n_generated == max_new_tokens:
+                break
+        end = time.perf_counter()
+        if ttft is None:
+            continue
+        runs.append(
+            {
+                "prompt_tokens": len(tokens),
+                "completion_tokens": n_generated,
+                "ttft_s": ttft,
+                # the first token is sampled right after the prompt is evaluated
+                "prompt_tokens_per_s": len(tokens) / ttft,
+                "decode_tokens_per_s": (
+                    (n_generated - 1) / (end - start - ttft) if n_generated > 1 else None
+                ),
+            }
+        )
+
+    def mean(key):
+        values = [r[key] for r in runs if r[key] is not None]
+        return statistics.fmean(values) if values else None
+
+    return {
+        "backend": backend,
+        "model": os.path.basename(model_path),
+        "quantization": get_quantization(model_path),
+        "load_s": load_seconds,
+        # kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "ttft_s": mean("ttft_s"),
+        "prompt_tokens_per_s": mean("prompt_tokens_per_s"),
+        "decode_tokens_per_s": mean("decode_tokens_per_s"),
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backends", type=str, nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--tiny", action="store_true", help="Benchmark TinyLlama for CI")
+    parser.add_argument("--prompts", type=str, default=DEFAULT_PROMPTS)
+    parser.add_argument("--num-prompts", type=int, help="Use the first prompts only")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--context-length", type=int, default=CFG.LLM_CONFIG.CONTEXT_LENGTH)
+    parser.add_argument("--threads", type=int, default=len(available_cores()))
+    parser.add_argument(
+        "--batch-size", type=int, default=512, help="Prompt tokens evaluated per forward pass"
+    )
+    parser.add_argument("--output", type=str, default="backend_bench.json")
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.prompts)[: args.num_prompts]
+    report = {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "threads": args.threads,
+        "batch_size": args.batch_size,
+        "max_new_tokens": args.max_new_tokens,
+        "results": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    for model_path in get_models(args.tiny):
+        if not os.path.exists(model_path):
+            logger.warning(f"Skipping {model_path}, which does not exist")
+            continue
+        for backend in args.backends:
+            logger.info(f"Benchmarking {os.path.basename(model_path)} with {backend} ...")
+            with context.Pool(1) as pool:
+                res = pool.apply(
+                    run_backend,
+                    (
+                        backend,
+                        model_path,
+                        prompts,
+                        args.max_new_tokens,
+                        args.context_length,
+                        args.threads,
+                        args.batch_size,
+                    ),
+                )
+            logger.info(
+                f"  load {res['load_s']:.1f}s, peak RSS {res['peak_rss_bytes'] / 2**20:.0f} MB, "
+                f"TTFT {res['ttft_s'] or float('nan'):.3f}s, "
+                f"prompt {res['prompt_tokens_per_s'] or float('nan'):.1f} tok/s, "
+                f"decode {res['decode_tokens_per_s'] or float('nan'):.1f} tok/s"
+            )
+            report["results"].append(res)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Load test for serve.py.
+
+Replays a JSONL workload of chat requests against the streaming chat completions
+endpoint and reports time to first token (TTFT), end-to-end latency and throughput.
+
+Each line of the workload is an OpenAI chat completions request body, e.g.
+{"messages": [{"role": "user", "content": "Hi"}], "max_tokens": 64}
+
+Run against a server started with the fake backend, so no model weights are needed:
+
+    python -m benchmarks.serve_bench --launch --concurrency 8 --rate 4
+"""
+
+import argparse
+import json
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+
+import requests
+from loguru import logger
+
+from benchmarks.utils import get_commit
+
+DEFAULT_WORKLOAD = "benchmarks/workloads/chat.jsonl"
+LAUNCH_PORT = 8299
+
+
+def load_workload(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def send_request(url: str, body: dict, timeout: float, scheduled: Optional[float] = None) -> dict:
+    """Sends a streaming request and times the first token and the last event from the
+    `scheduled` arrival time, if given, so that time waiting for a free client thread is
+    included. The optional `priority` field of the body is sent as the X-Priority header."""
+    body = dict(body)
+    priority = body.pop("priority", "interactive")
+    start = scheduled if scheduled is not None else time.perf_counter()
+    ttft = None
+    n_chunks = 0
+    try:
+        with requests.post(
+            url + "/v1/chat/completions",
+            json={**body, "stream": True},
+            headers={"X-Priority": priority},
+            stream=True,
+            timeout=timeout,
+        ) as r:
+            if r.status_code != 200:
+                latency = time.perf_counter() - start
+                return {"ok": False, "status": r.status_code, "latency": latency}
+            for line in r.iter_lines():
+                if not line.startswith(b"data: ") or line == b"data: [DONE]":
+                    continue
+                chunk = json.loads(line[len(b"data: "):])
+                if chunk["choices"][0]["delta"].get("content"):
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    # one chunk per token, except where stop-string holdback merges tokens
+                    n_chunks += 1
+    except requests.RequestException as e:
+        logger.warning(e)
+        return {"ok": False, "status": None, "latency": time.perf_counter() - start}
+
+    return {
+        "ok": True,
+        "status": 200,
+        "ttft": ttft,
+        "latency": time.perf_counter() - start,
+        "completion_chunks": n_chunks,
+    }
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    return {
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+        "mean": statistics.fmean(values),
+        "max": values[-1],
+    }
+
+
+def run(
+    url: str,
+    workload: list[dict],
+    num_requests: int,
+    concurrency: int,
+    rate: float,
+    timeout: float,
+    seed: int,
+) -> dict:
+    """Sends requests at Poisson arrivals of `rate` per second (all at once if rate is 0),
+    with at most `concurrency` requests in flight. With a rate, requests are timed from
+    their scheduled arrival, to avoid coordinated omission when the client queue backs up."""
+    rng = random.Random(seed)
+    results = []
+    lock = threading.Lock()
+
+    def task(body, scheduled):
+        res = send_request(url, body, timeout, scheduled)
+        with lock:
+            results.append(res)
+
+    start = time.perf_counter()
+    scheduled = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(num_requests):
+            if rate > 0:
+                # arrivals follow the schedule even if the loop falls behind
+                scheduled = (scheduled or start) + rng.expovariate(rate)
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+            executor.submit(task, workload[i % len(workload)], scheduled)
+    duration = time.perf_counter() - start
+
+    ok = [r for r in results if r["ok"]]
+    completion_chunks = sum(r["completion_chunks"] for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "failed": {
+            str(status): sum(r["status"] == status for r in results if not r["ok"])
+            for status in {r["status"] for r in results if not r["ok"]}
+        },
+        "duration_s": duration,
+        "requests_per_s": len(ok) / duration,
+        "tokens_per_s": completion_chunks / duration,
+        "ttft_s": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "latency_s": percentiles([r["latency"] for r in ok]),
+    }
+
+
+def launch_server(port: int) -> subprocess.Popen:
+    """Starts serve.py with the fake backend and waits until its default model is warm,
+    so that the warmup does not count towards the TTFT of the first requests."""
+    proc = subprocess.Popen(
+        [sys.executable, "serve.py", "--backend", "fake", "--port", str(port)],
+    )
+    url = f"http://localhost:{port}"
+    for _ in range(100):
+        try:
+            response = requests.get(url + "/readyz", timeout=1)
+        except requests.RequestException:
+            time.sleep(0.2)
+            continue
+        if response.ok:
+            return proc
+        if response.json().get("status") == "failed":
+            break
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("serve.py did not become ready")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", type=str, default="http://localhost:8200")
+    parser.add_argument("--workload", type=str, default=DEFAULT_WORKLOAD)
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--rate", type=float, default=0, help="Arrivals per second, 0 for burst")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--launch", action="store_true", help="Start serve.py with fake backend")
+    parser.add_argument("--output", type=str, default="serve_bench.json")
+    args = parser.parse_args()
+
+    proc = None
+    url = args.url
+    if args.launch:
+        proc = launch_server(LAUNCH_PORT)
+        url = f"http://localhost:{LAUNCH_PORT}"
+
+    workload = load_workload(args.workload)
+    report = {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "url": url,
+        "workload": args.workload,
+        "rate": args.rate,
+        "runs": [],
+    }
+    try:
+        for concurrency in args.concurrency:
+            logger.info(f"Running {args.num_requests} requests at concurrency {concurrency}")
+            res = run(
+                url, workload, args.num_requests, concurrency, args.rate, args.timeout, args.seed
+            )
+            logger.info(
+                f"  {res['tokens_per_s']:.1f} tokens/s, "
+                f"TTFT p50 {res['ttft_s'].get('p50', float('nan')):.3f}s, "
+                f"latency p99 {res['latency_s'].get('p99', float('nan')):.3f}s"
+            )
+            report["runs"].append({"concurrency": concurrency, **res})
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+"""Helpers shared by the benchmarks, without third-party dependencies."""
+
+import subprocess
+from typing import Optional
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -1,122 +1,483 @@
 import argparse
+import asyncio
+import dataclasses
+import json
+import os
 import time
 import uuid
-import asyncio
-from typing import AsyncIterable, Awaitable
+from typing import Optional, Union
 
 import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request as HTTPRequest
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from loguru import logger
 from pydantic import BaseModel
-from langchain.llms.ctransformers import CTransformers
-from langchain.callbacks import (
-    AsyncIteratorCallbackHandler,
-    StreamingStdOutCallbackHandler,
-)
 
-from src import CFG
-from src.prompt_format import Llama2Format, MistralFormat, CodeLlamaFormat
+from src import CFG, metrics
+from src.admission import LANES, AdmissionController, add_overloaded_handler, get_lane
+from src.embeddings import EmbeddingBatcher
+from src.engine import (
+    CTransformersBackend,
+    Engine,
+    FakeBackend,
+    GenerationParams,
+    LlamaCppBackend,
+    SpeculativeBackend,
+)
+from src.health import Readiness, add_health_routes, prefetch
+from src.model_pool import ModelPool, ModelSpec
+from src.prompt_format import CodeLlamaFormat, Llama2Format, MistralFormat, PromptTooLongError
+from src.response_cache import ResponseCache
+from src.workers import available_cores, run_workers
 
-ASYNC_CALLBACK = AsyncIteratorCallbackHandler()
+# config section and prompt format of each servable model
+MODELS = {
+    "llama2": ("LLAMA2", Llama2Format),
+    "codellama": ("CODELLAMA", CodeLlamaFormat),
+    "mistral": ("MISTRAL", MistralFormat),
+}
 
 
 class Request(BaseModel):
     messages: list[dict[str, str]]
+    # OpenAI model name; defaults to the model given by --model
+    model: Optional[str] = None
+    # OpenAI end-user id, used as the session key of the prefix cache
+    user: Optional[str] = None
+    # generation parameters, defaulting to LLM_CONFIG
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    stop: Optional[Union[str, list[str]]] = None
+    stream: bool = False
+
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, list[str]]
+    model: Optional[str] = None
 
 
 app = FastAPI()
+add_overloaded_handler(app)
+READINESS = Readiness()
+add_health_routes(app, READINESS)
+
+
+def build_specs() -> dict[str, ModelSpec]:
+    """Builds the spec of every model in config, keyed by model name."""
+    kv_bytes = CFG.LLM_CONFIG.CONTEXT_LENGTH * CFG.SERVE.KV_BYTES_PER_TOKEN
+    specs = dict()
+    for section, prompt_format in MODELS.values():
+        cfg = CFG[section]
+        specs[cfg.MODEL_NAME] = ModelSpec(
+            name=cfg.MODEL_NAME,
+            model_path=os.path.join(CFG.MODELS_DIR, cfg.MODEL_PATH),
+            prompt_format=prompt_format(),
+            kv_cache_bytes=int(CFG.SERVE.KV_CACHE_MB * 2**20 // kv_bytes) * kv_bytes,
+            draft_model_path=(
+                os.path.join(CFG.MODELS_DIR, cfg.DRAFT_MODEL_PATH)
+                if cfg.get("DRAFT_MODEL_PATH")
+                else None
+            ),
+        )
+    return specs
+
+
+def build_engine(spec: ModelSpec) -> Engine:
+    if BACKEND == "fake":
+        return Engine(
+            lambda: FakeBackend(context_length=CFG.LLM_CONFIG.CONTEXT_LENGTH),
+            max_batch_size=CFG.SERVE.MAX_BATCH_SIZE,
+            name=spec.name,
+        )
+
+    llm_config = {
+        "max_new_tokens": CFG.LLM_CONFIG.MAX_NEW_TOKENS,
+        "temperature": CFG.LLM_CONFIG.TEMPERATURE,
+        "repetition_penalty": CFG.LLM_CONFIG.REPETITION_PENALTY,
+        "context_length": CFG.LLM_CONFIG.CONTEXT_LENGTH,
+    }
+    # The cores of this worker are split between the active sequences on every step, so
+    # a single request decodes with all of them; weights are mmap-shared across slots and
+    # workers
+    batch_size = CFG.SERVE.MAX_BATCH_SIZE
+    threads = len(available_cores())
+    # Extra contexts keep the KV state of idle sessions, within the memory budget
+    kv_bytes = CFG.LLM_CONFIG.CONTEXT_LENGTH * CFG.SERVE.KV_BYTES_PER_TOKEN
+
+    def backend_factory():
+        if spec.draft_model_path is None:
+            return CTransformersBackend(spec.model_path, config={**llm_config, "threads": threads})
+        # verifying drafted tokens needs the logits of every position, which only
+        # llama.cpp exposes
+        config = {"n_ctx": CFG.LLM_CONFIG.CONTEXT_LENGTH, "n_threads": threads}
+        return SpeculativeBackend(
+            LlamaCppBackend(spec.model_path, config={**config, "logits_all": True}),
+            LlamaCppBackend(spec.draft_model_path, config=config),
+            num_draft_tokens=CFG.SERVE.NUM_DRAFT_TOKENS,
+            name=spec.name,
+        )
+
+    return Engine(
+        backend_factory,
+        max_batch_size=batch_size,
+        num_slots=spec.kv_cache_bytes // kv_bytes,
+        num_threads=threads,
+        name=spec.name,
+    )
+
+
+def load_engine(spec: ModelSpec) -> Engine:
+    """Builds the engine and runs a warmup generation, so that the first request does not
+    pay for page faults of the weights and allocation of the buffers."""
+    if CFG.PREFETCH_WEIGHTS:
+        prefetch(spec.model_path)
+    engine = build_engine(spec)
+    start = time.perf_counter()
+    seq = engine.submit(WARMUP_PROMPT, dataclasses.replace(GENERATION_PARAMS, max_new_tokens=1))
+    seq.future.result()
+    logger.info(f"Warmed up {spec.name} in {time.perf_counter() - start:.1f}s")
+    return engine
+
+
+WARMUP_PROMPT = "Hello"
+# "ctransformers", or "fake" to benchmark the serving layer without model weights
+BACKEND = CFG.SERVE.BACKEND
+GENERATION_PARAMS = GenerationParams(
+    max_new_tokens=CFG.LLM_CONFIG.MAX_NEW_TOKENS,
+    temperature=CFG.LLM_CONFIG.TEMPERATURE,
+    repetition_penalty=CFG.LLM_CONFIG.REPETITION_PENALTY,
+)
+POOL = ModelPool(build_specs(), load_engine, memory_budget=CFG.SERVE.RAM_BUDGET_MB * 2**20)
+DEFAULT_MODEL = CFG.LLAMA2.MODEL_NAME
+ADMISSION = AdmissionController(
+    max_concurrency=CFG.ADMISSION.SERVE.MAX_CONCURRENCY,
+    max_queue=CFG.ADMISSION.SERVE.MAX_QUEUE,
+    max_queue_wait=CFG.ADMISSION.SERVE.MAX_QUEUE_WAIT,
+)
+RESPONSE_CACHE = (
+    ResponseCache(
+        max_entries=CFG.RESPONSE_CACHE.MAX_ENTRIES,
+        ttl=CFG.RESPONSE_CACHE.TTL,
+        path=CFG.RESPONSE_CACHE.PATH,
+    )
+    if CFG.RESPONSE_CACHE.ENABLED
+    else None
+)
+EMBEDDINGS = EmbeddingBatcher(
+    CFG.EMBEDDINGS.MODEL_NAME,
+    max_batch_size=CFG.EMBEDDINGS.MAX_BATCH_SIZE,
+    max_wait=CFG.EMBEDDINGS.MAX_WAIT_MS / 1000,
+    cache_size=CFG.EMBEDDINGS.CACHE_SIZE,
+    device=CFG.DEVICE,
+)
+
+metrics.Gauge(
+    "llm_queue_depth",
+    "Requests waiting for a slot.",
+    ("model",),
+    collect=lambda: {(m.name,): m.engine.num_waiting for m in POOL.models.values()},
+)
+metrics.Gauge(
+    "llm_active_sequences",
+    "Sequences being decoded.",
+    ("model",),
+    collect=lambda: {(m.name,): m.engine.num_active for m in POOL.models.values()},
+)
+metrics.Gauge(
+    "llm_active_sessions",
+    "Chat sessions holding cached KV state.",
+    ("model",),
+    collect=lambda: {(m.name,): m.engine.num_sessions for m in POOL.models.values()},
+)
+metrics.Gauge(
+    "llm_admission_queue_depth",
+    "Requests waiting for admission.",
+    collect=lambda: {(): ADMISSION.queued},
+)
+metrics.Gauge(
+    "llm_loaded_model_bytes",
+    "Estimated memory of loaded models.",
+    ("model",),
+    collect=lambda: {(m.name,): m.spec.memory_bytes for m in POOL.models.values()},
+)
+
+
+def get_params(request: Request) -> GenerationParams:
+    """Overrides the default generation parameters with those of the request. Responds
+    with 400 if max_tokens leaves no room for the prompt in the context."""
+    params = GENERATION_PARAMS
+    if request.max_tokens is not None:
+        context_length = CFG.LLM_CONFIG.CONTEXT_LENGTH
+        if not 0 < request.max_tokens < context_length:
+            raise HTTPException(
+                status_code=400,
+                detail=(
+                    f"max_tokens must be between 1 and {context_length - 1}, as the context "
+                    f"length is {context_length} tokens, got {request.max_tokens}"
+                ),
+            )
+        params = dataclasses.replace(params, max_new_tokens=request.max_tokens)
+    if request.temperature is not None:
+        params = dataclasses.replace(params, temperature=request.temperature)
+    if request.stop:
+        stop = [request.stop] if isinstance(request.stop, str) else request.stop
+        params = dataclasses.replace(params, stop=stop)
+    return params
+
+
+def get_prompt(model, request: Request) -> str:
+    """Formats the messages, dropping the oldest turns that do not fit in the context.
+    Responds with 400 if the latest message alone does not fit."""
+    try:
+        return model.prompt_format.get_prompt(
+            request.messages,
+            max_tokens=CFG.LLM_CONFIG.CONTEXT_LENGTH - get_params(request).max_new_tokens,
+            tokenize=model.engine.tokenizer.tokenize,
+        )
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def check_prompt(request: Request, started: float) -> None:
+    """Validates the prompt before a stream starts, which can no longer respond with 400.
+    Releases the admission permit if it is rejected."""
+    try:
+        async with POOL.acquire(get_model_name(request)) as model:
+            get_prompt(model, request)
+    except BaseException:
+        ADMISSION.release(started)
+        raise
+
+
+def get_model_name(request: Request) -> str:
+    name = request.model or DEFAULT_MODEL
+    # also accept the short names of --model
+    if name in MODELS:
+        name = CFG[MODELS[name][0]].MODEL_NAME
+    if name not in POOL.specs:
+        raise HTTPException(status_code=404, detail=f"Model '{name}' not found")
+    return name
+
+
+def get_usage(seq) -> dict:
+    return {
+        "completion_tokens": len(seq.output_tokens),
+        "prompt_tokens": len(seq.prompt_tokens),
+        "total_tokens": len(seq.prompt_tokens) + len(seq.output_tokens),
+        "prompt_tokens_details": {"cached_tokens": seq.cached_tokens},
+    }
+
+
+@app.on_event("startup")
+async def preload() -> None:
+    """Loads and warms up the default model in the background. /readyz turns ready after."""
+
+    async def load():
+        async with POOL.acquire(DEFAULT_MODEL):
+            pass
+
+    # keep a reference so that the task is not garbage collected
+    app.state.preload = asyncio.create_task(READINESS.warm_up(load))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    # runs on the event loop, which is where POOL.models is changed, so that the gauges
+    # never see it mid-update
+    return metrics.render()
+
+
+@app.get("/v1/models")
+def list_models() -> dict:
+    return {
+        "object": "list",
+        "data": [
+            {"id": name, "object": "model", "owned_by": "local", "loaded": name in POOL.models}
+            for name in POOL.specs
+        ],
+    }
+
+
+async def cancel_on_disconnect(http_request: HTTPRequest, engine, seq) -> None:
+    """Cancels the sequence if the client goes away before it finishes."""
+    while not seq.finished:
+        if await http_request.is_disconnected():
+            logger.info(f"Client disconnected, cancelling {seq.id}")
+            engine.cancel(seq)
+            return
+        await asyncio.sleep(0.5)
+
+
+@app.post("/v1/embeddings")
+@app.post("/embeddings")
+async def create_embeddings(request: EmbeddingRequest) -> dict:
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    vectors, num_tokens = await EMBEDDINGS.embed(texts)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": vector.tolist()}
+            for i, vector in enumerate(vectors)
+        ],
+        "model": EMBEDDINGS.model_name,
+        "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens},
+    }
 
 
 # chat completion
 @app.get("/v1/chat/completions")
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
-def chat_completion(request: Request) -> dict:
-    prompt = PROMPT_FORMAT.get_prompt(request.messages)
-    print(prompt)
-    output = LLM.invoke(prompt)
+async def chat_completion(request: Request, http_request: HTTPRequest):
+    model_name = get_model_name(request)
+    if request.stream:
+        started = await ADMISSION.acquire(get_lane(http_request))
+        await check_prompt(request, started)
+        return StreamingResponse(
+            release_when_done(chat_completion_chunks(request, get_lane(http_request)), started),
+            media_type="text/event-stream",
+        )
+
+    params = get_params(request)
+    if RESPONSE_CACHE is not None and params.temperature <= CFG.RESPONSE_CACHE.MAX_TEMPERATURE:
+        # The formatted prompt is fully determined by the model and the messages
+        key = ResponseCache.make_key(model_name, request.messages, dataclasses.asdict(params))
+        result = await RESPONSE_CACHE.get_or_compute(
+            key,
+            lambda: generate_completion(request, http_request, model_name),
+            cacheable=lambda r: r["finish_reason"] in ("stop", "length"),
+        )
+    else:
+        result = await generate_completion(request, http_request, model_name)
 
     return {
         "object": "chat.completion",
         "choices": [
             {
-                "finish_reason": "stop",
+                "finish_reason": result["finish_reason"],
                 "index": 0,
                 "message": {
-                    "content": output,
+                    "content": result["content"],
                     "role": "assistant",
                 },
             }
         ],
         "id": "chatcmpl-" + str(uuid.uuid4()),
         "created": time.time(),
-        "model": MODEL_NAME,
-        "usage": {"completion_tokens": -1, "prompt_tokens": -1, "total_tokens": -1},
+        "model": model_name,
+        "usage": result["usage"],
     }
 
 
-async def request_stream(prompt: str) -> AsyncIterable[str]:
-    async def wrap_done(fn: Awaitable, event: asyncio.Event):
-        """Wrap an awaitable with a event to signal when it's done or an exception is raised."""
+async def generate_completion(
+    request: Request, http_request: HTTPRequest, model_name: str
+) -> dict:
+    async with ADMISSION.admit(get_lane(http_request)), POOL.acquire(model_name) as model:
+        prompt = get_prompt(model, request)
+        logger.debug(prompt)
+        seq = model.engine.submit(
+            prompt,
+            get_params(request),
+            session_id=request.user,
+            priority=LANES.index(get_lane(http_request)),
+        )
+        watcher = asyncio.create_task(cancel_on_disconnect(http_request, model.engine, seq))
         try:
-            await fn
-        except Exception as e:
-            # TODO: handle exception
-            print(f"Caught exception: {e}")
+            await asyncio.wrap_future(seq.future)
         finally:
-            # Signal the aiter to stop.
-            event.set()
+            watcher.cancel()
+
+    return {"content": seq.text, "finish_reason": seq.finish_reason, "usage": get_usage(seq)}
+
+
+async def chat_completion_chunks(request: Request, lane: str):
+    """Yields OpenAI `chat.completion.chunk` server-sent events. Generation is cancelled
+    when the client disconnects and the response stops being consumed."""
+    async with POOL.acquire(get_model_name(request)) as model:
+        prompt = get_prompt(model, request)
+        logger.debug(prompt)
+        seq = model.engine.submit(
+            prompt,
+            get_params(request),
+            stream=True,
+            session_id=request.user,
+            priority=LANES.index(lane),
+        )
+        chunk = {
+            "id": "chatcmpl-" + seq.id,
+            "object": "chat.completion.chunk",
+            "created": time.time(),
+            "model": model.name,
+        }
 
-    # Begin a task that runs in the background.
-    task = asyncio.create_task(wrap_done(LLM.ainvoke(prompt), ASYNC_CALLBACK.done))
+        def event(delta: dict, finish_reason: Optional[str] = None) -> str:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            return f"data: {json.dumps({**chunk, 'choices': [choice]})}\n\n"
 
-    async for token in ASYNC_CALLBACK.aiter():
-        # Use server-sent-events to stream the response
-        yield f"{token}"
+        yield event({"role": "assistant", "content": ""})
+        async for token in model.engine.iter_text(seq):
+            yield event({"content": token})
+        yield event({}, seq.finish_reason)
+        yield "data: [DONE]\n\n"
 
-    await task
+
+async def request_stream(request: Request, lane: str):
+    async with POOL.acquire(get_model_name(request)) as model:
+        prompt = get_prompt(model, request)
+        logger.debug(prompt)
+        async for token in model.engine.stream(
+            prompt, get_params(request), session_id=request.user, priority=LANES.index(lane)
+        ):
+            yield token
+
+
+async def release_when_done(stream, started: float):
+    """Holds the admission permit until the response stream ends."""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        ADMISSION.release(started)
 
 
 @app.get("/stream")
 @app.post("/stream")
-async def chat_completion_stream(request: Request):
-    prompt = PROMPT_FORMAT.get_prompt(request.messages)
-    print(prompt)
-    return StreamingResponse(request_stream(prompt), media_type="text/event-stream")
+async def chat_completion_stream(request: Request, http_request: HTTPRequest):
+    get_model_name(request)
+    started = await ADMISSION.acquire(get_lane(http_request))
+    await check_prompt(request, started)
+    return StreamingResponse(
+        release_when_done(request_stream(request, get_lane(http_request)), started),
+        media_type="text/event-stream",
+    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-model", "--model", type=str)
+    parser.add_argument(
+        "-model",
+        "--model",
+        type=str,
+        choices=list(MODELS),
+        help="Default model, loaded at startup. Other models are loaded on demand.",
+    )
+    parser.add_argument("--backend", type=str, choices=["ctransformers", "fake"])
+    parser.add_argument("--port", type=int, help="Overrides the port in config")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=CFG.SERVE.WORKERS,
+        help="Worker processes, each pinned to its share of the cores",
+    )
     args = parser.parse_args()
+    if args.backend is not None:
+        BACKEND = args.backend
 
-    if args.model == "llama2":
-        MODEL_NAME = CFG.LLAMA2.MODEL_NAME
-        model_path = f"{CFG.MODELS_DIR}/{CFG.LLAMA2.MODEL_PATH}"
-        PROMPT_FORMAT = Llama2Format()
-        port = CFG.PORT.LLAMA2
-    elif args.model == "codellama":
-        MODEL_NAME = CFG.CODELLAMA.MODEL_NAME
-        model_path = f"{CFG.MODELS_DIR}/{CFG.CODELLAMA.MODEL_PATH}"
-        PROMPT_FORMAT = CodeLlamaFormat()
-        port = CFG.PORT.CODELLAMA
-    elif args.model == "mistral":
-        MODEL_NAME = CFG.MISTRAL.MODEL_NAME
-        model_path = f"{CFG.MODELS_DIR}/{CFG.MISTRAL.MODEL_PATH}"
-        PROMPT_FORMAT = MistralFormat()
-        port = CFG.PORT.MISTRAL
-    else:
-        raise NotImplementedError
-
-    LLM = CTransformers(
-        model=model_path,
-        config={
-            "max_new_tokens": CFG.LLM_CONFIG.MAX_NEW_TOKENS,
-            "temperature": CFG.LLM_CONFIG.TEMPERATURE,
-            "repetition_penalty": CFG.LLM_CONFIG.REPETITION_PENALTY,
-            "context_length": CFG.LLM_CONFIG.CONTEXT_LENGTH,
-        },
-        callbacks=[ASYNC_CALLBACK, StreamingStdOutCallbackHandler()],
-    )
+    if args.model is not None:
+        DEFAULT_MODEL = CFG[MODELS[args.model][0]].MODEL_NAME
+    port = args.port or CFG.PORT.SERVE
 
-    uvicorn.run(app, host=CFG.HOST, port=port)
+    if args.workers > 1:
+        run_workers(app, host=CFG.HOST, port=port, num_workers=args.workers)
+    else:
+        uvicorn.run(app, host=CFG.HOST, port=port)
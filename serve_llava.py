@@ -1,22 +1,113 @@
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request as HTTPRequest
+from fastapi.responses import StreamingResponse
+from loguru import logger
 from pydantic import BaseModel
 
 from src import CFG
+from src.admission import AdmissionController, add_overloaded_handler, get_lane
+from src.health import Readiness, add_health_routes, prefetch
 from src.llava import load_llava
 
-LLM = load_llava()
+LLM = None
+# The llama.cpp context is not thread-safe, so inference runs on one dedicated thread
+# that takes requests in order, off the event loop
+EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llava")
 
 app = FastAPI()
+add_overloaded_handler(app)
+READINESS = Readiness()
+add_health_routes(app, READINESS)
+
+ADMISSION = AdmissionController(
+    max_concurrency=CFG.ADMISSION.LLAVA.MAX_CONCURRENCY,
+    max_queue=CFG.ADMISSION.LLAVA.MAX_QUEUE,
+    max_queue_wait=CFG.ADMISSION.LLAVA.MAX_QUEUE_WAIT,
+)
 
 
 class Request(BaseModel):
     inputs: list
+    stream: bool = False
+
+
+def load_and_warm_up() -> None:
+    global LLM
+    if CFG.PREFETCH_WEIGHTS:
+        prefetch(os.path.join(CFG.MODELS_DIR, CFG.LLAVA_MODEL_PATH))
+        prefetch(os.path.join(CFG.MODELS_DIR, CFG.CLIP_MODEL_PATH))
+    llm = load_llava()
+    llm.create_chat_completion(messages=[{"role": "user", "content": "Hello"}], max_tokens=1)
+    LLM = llm
+
+
+@app.on_event("startup")
+async def preload() -> None:
+    """Loads and warms up LLaVA in the background. /readyz turns ready after."""
+    # keep a reference so that the task is not garbage collected
+    app.state.preload = asyncio.create_task(
+        READINESS.warm_up(lambda: asyncio.to_thread(load_and_warm_up))
+    )
+
+
+def generate_chunks(messages: list, loop, queue: asyncio.Queue, cancelled: threading.Event):
+    """Runs on the inference thread and pushes chunks to the queue, then None."""
+    try:
+        for chunk in LLM.create_chat_completion(messages=messages, stream=True):
+            if cancelled.is_set():
+                logger.info("Client disconnected, cancelling generation")
+                break
+            loop.call_soon_threadsafe(queue.put_nowait, chunk)
+    except Exception as e:
+        logger.exception("Generation failed")
+        loop.call_soon_threadsafe(queue.put_nowait, e)
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+
+async def stream_response(messages: list, started: float):
+    """Yields `chat.completion.chunk` server-sent events, then `[DONE]`, or an `error`
+    event if generation fails. Holds the admission permit until the stream ends and stops
+    generating when the response stops being consumed."""
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+    loop = asyncio.get_running_loop()
+    EXECUTOR.submit(generate_chunks, messages, loop, queue, cancelled)
+    try:
+        while (chunk := await queue.get()) is not None:
+            if isinstance(chunk, Exception):
+                # end without [DONE], so that clients do not take the answer as complete
+                error = {"message": str(chunk), "type": type(chunk).__name__}
+                yield f"data: {json.dumps({'error': error})}\n\n"
+                return
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        cancelled.set()
+        ADMISSION.release(started)
 
 
 @app.post("/")
-async def get_response(request: Request) -> dict:
-    output = LLM.create_chat_completion(messages=request.inputs)
+async def get_response(request: Request, http_request: HTTPRequest):
+    if LLM is None:
+        raise HTTPException(
+            status_code=503, detail="Model is loading", headers={"Retry-After": "10"}
+        )
+    if request.stream:
+        started = await ADMISSION.acquire(get_lane(http_request))
+        return StreamingResponse(
+            stream_response(request.inputs, started), media_type="text/event-stream"
+        )
+
+    async with ADMISSION.admit(get_lane(http_request)):
+        future = EXECUTOR.submit(LLM.create_chat_completion, messages=request.inputs)
+        output = await asyncio.wrap_future(future)
     return output
 
 
@@ -0,0 +1,125 @@
+"""
+Admission control for the local model servers.
+
+Requests wait in a bounded queue for one of `max_concurrency` permits. Interactive
+requests are always admitted before batch requests. When the queue is full, or a
+request waits longer than `max_queue_wait`, it is rejected immediately. The rejection
+carries a Retry-After estimate, so that bursts do not pile up inside the server.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# lanes in order of priority
+LANES = ("interactive", "batch")
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded priority queue in front of a limited number of concurrent requests.
+
+    Args:
+        max_concurrency: Number of requests served at the same time.
+        max_queue: Number of requests allowed to wait; more are rejected with 429.
+        max_queue_wait: Seconds a request may wait before it is rejected with 503.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_wait: float) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.running = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        # moving average of the time a permit is held
+        self._service_time = 1.0
+
+    @property
+    def queued(self) -> int:
+        return sum(not f.done() for _, _, f in self._waiters)
+
+    def retry_after(self) -> int:
+        """Estimated seconds until a new request could be served."""
+        backlog = self.queued + 1
+        return max(1, math.ceil(self._service_time * backlog / self.max_concurrency))
+
+    async def acquire(self, lane: str = "interactive") -> float:
+        """Waits for a permit. Returns the time it was granted."""
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane '{lane}', expected one of {LANES}")
+
+        if self.running < self.max_concurrency and not self.queued:
+            self.running += 1
+            return time.perf_counter()
+
+        if self.queued >= self.max_queue:
+            raise Overloaded(429, "Too many queued requests", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (LANES.index(lane), next(self._counter), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_queue_wait)
+        except asyncio.TimeoutError:
+            if future.done():
+                # granted just as the timeout fired
+                return future.result()
+            future.cancel()
+            raise Overloaded(503, "Timed out waiting in queue", self.retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(future.result())
+            else:
+                future.cancel()
+            raise
+        return future.result()
+
+    def release(self, started: float) -> None:
+        """Returns a permit and hands it to the next waiter of the highest priority lane."""
+        elapsed = time.perf_counter() - started
+        self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # the permit passes on without decrementing running
+                future.set_result(time.perf_counter())
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def admit(self, lane: str = "interactive") -> AsyncIterator[None]:
+        started = await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(started)
+
+
+def get_lane(request: Request) -> str:
+    """Reads the priority lane from the `X-Priority` header."""
+    lane = request.headers.get("X-Priority", LANES[0]).lower()
+    return lane if lane in LANES else LANES[0]
+
+
+def add_overloaded_handler(app: FastAPI) -> None:
+    @app.exception_handler(Overloaded)
+    async def overloaded_handler(request: Request, exc: Overloaded) -> JSONResponse:
+        return JSONResponse(
+            status_code=exc.status_code,
+            content={"detail": exc.detail},
+            headers={"Retry-After": str(exc.retry_after)},
+        )
@@ -1,21 +1,396 @@
-from typing import List, Sequence, Tuple, Union
-
+import asyncio
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.callbacks import (
+    AsyncCallbackManager,
+    AsyncCallbackManagerForChainRun,
+    CallbackManager,
+    CallbackManagerForChainRun,
+)
+from langchain_core.exceptions import OutputParserException
 from langchain_core.language_models import BaseLanguageModel
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.load import dumpd
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from langchain_core.prompts import BasePromptTemplate, ChatPromptTemplate
-from langchain_core.runnables import Runnable, RunnablePassthrough
+from langchain_core.runnables import Runnable, RunnableConfig, RunnablePassthrough
+from langchain_core.runnables.config import ensure_config, get_callback_manager_for_config
 from langchain_core.tools import BaseTool
 
+from langchain.agents import AgentExecutor
+from langchain.agents.agent import MultiActionAgentOutputParser
 from langchain.agents.format_scratchpad import (
     format_log_to_str,
     format_to_openai_function_messages,
 )
 from langchain.agents.output_parsers import (
-    ReActSingleInputOutputParser,
     OpenAIFunctionsAgentOutputParser,
+    ReActSingleInputOutputParser,
 )
 from langchain.tools.render import render_text_description
 
+FINAL_ANSWER_ACTION = "Final Answer:"
+ACTION_REGEX = re.compile(
+    r"Action\s*\d*\s*:[\s]*(.*?)[\s]*Action\s*\d*\s*Input\s*\d*\s*:[\s]*(.*?)"
+    r"(?=\n\s*(?:Thought|Observation|Action\s*\d*)\s*:|\Z)",
+    re.DOTALL,
+)
+OBSERVATION_REGEX = re.compile(r"\n\s*Observation\s*:")
+
+
+class ToolCall:
+    """Runs a function on its own daemon thread, so that the tool calls of an agent step
+    run concurrently. The tavily and wikipedia clients have no socket timeout, and a call
+    that hangs must not hold up others as it would in a shared pool.
+    """
+
+    def __init__(self, func, *args, **kwargs) -> None:
+        self.started = time.monotonic()
+        self.future = Future()
+        threading.Thread(
+            target=self._run, args=(func, args, kwargs), name="tool", daemon=True
+        ).start()
+
+    def _run(self, func, args, kwargs) -> None:
+        try:
+            self.future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            self.future.set_exception(e)
+
+    def result(self, timeout: float) -> Any:
+        """Waits for at most `timeout` seconds since the call started."""
+        return self.future.result(timeout=max(0.0, self.started + timeout - time.monotonic()))
+
+    async def aresult(self, timeout: float) -> Any:
+        """Awaits the result for at most `timeout` seconds since the call started."""
+        # shielded, as the call cannot be cancelled and still sets its result
+        return await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(self.future)),
+            timeout=max(0.0, self.started + timeout - time.monotonic()),
+        )
+
+
+def start_tool(tool: BaseTool, tool_input: Union[str, dict]) -> ToolCall:
+    # callbacks are fired by the executor as it collects the result
+    return ToolCall(tool.run, tool_input, callbacks=None)
+
+
+def _parse_tool_call(match: re.Match) -> Tuple[str, str]:
+    return match.group(1).strip(), match.group(2).strip().strip('"')
+
+
+class ReActMultiInputOutputParser(MultiActionAgentOutputParser):
+    """Parses ReAct-style LLM output with one or more `Action:`/`Action Input:` pairs,
+    which are independent tool calls to run in the same step."""
+
+    def parse(self, text: str) -> Union[List[AgentAction], AgentFinish]:
+        matches = list(ACTION_REGEX.finditer(text))
+        if not matches:
+            # reuse the error handling of the single input parser
+            return ReActSingleInputOutputParser().parse(text)
+        if FINAL_ANSWER_ACTION in text:
+            raise OutputParserException(
+                f"Parsing LLM output produced both a final answer and a parse-able action: {text}"
+            )
+
+        actions = []
+        end = 0
+        for i, match in enumerate(matches):
+            tool, tool_input = _parse_tool_call(match)
+            # each action carries the thought before it, so that the scratchpad reads as
+            # a sequence of Thought/Action/Observation
+            log = text[end:match.end()]
+            if i > 0:
+                log = re.sub(r"^\s*(Thought\s*:)?\s*", "", log)
+            end = match.end()
+            actions.append(AgentAction(tool, tool_input, log))
+        return actions
+
+    @property
+    def _type(self) -> str:
+        return "react-multi-input"
+
+
+class StartedAgentAction(AgentAction):
+    """AgentAction whose tool call was started by the output parser."""
+
+    tool_call: Any = None
+    """ToolCall started by the parser."""
+
+
+class ReActStreamingOutputParser(ReActMultiInputOutputParser):
+    """Parses ReAct-style LLM output as the LLM streams it.
+
+    The generation is cancelled as soon as the actions of the step are complete, i.e.
+    when the LLM goes on to write an `Observation:` itself. The calls of the tools in
+    `tools` start as soon as their `Action Input:` is complete, and are returned as
+    StartedAgentActions. A started call is never run a second time: its action keeps the
+    input the call was started with. Calls cannot be cancelled, so if the output then
+    fails to parse, the started calls are abandoned but still run to completion. Tokens
+    of a final answer are passed to the `on_text` callbacks as they arrive, with
+    `final_answer=True`.
+    """
+
+    tools: Dict[str, BaseTool] = {}
+    """Tools to start while parsing, by name."""
+
+    def transform(
+        self,
+        input: Iterator[Union[str, BaseMessage]],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Iterator[Union[List[AgentAction], AgentFinish]]:
+        # _transform_stream_with_config would read the rest of the stream for tracing
+        config = ensure_config(config)
+        run_manager = get_callback_manager_for_config(config).on_chain_start(
+            dumpd(self),
+            {"input": ""},
+            run_type="parser",
+            name=config.get("run_name") or self.get_name(),
+        )
+        try:
+            output = self._parse_stream(input, run_manager)
+        except BaseException as e:
+            run_manager.on_chain_error(e)
+            raise
+        run_manager.on_chain_end(output)
+        yield output
+
+    def _parse_stream(
+        self, chunks: Iterator[Union[str, BaseMessage]], run_manager: CallbackManagerForChainRun
+    ) -> Union[List[AgentAction], AgentFinish]:
+        text = ""
+        # (tool, tool input, ToolCall or None for unknown tools) of the complete actions
+        started = []
+        streamed = 0
+        for chunk in chunks:
+            text += chunk.content if isinstance(chunk, BaseMessage) else chunk
+            matches = list(ACTION_REGEX.finditer(text))
+            if not matches:
+                if FINAL_ANSWER_ACTION in text:
+                    answer = text.split(FINAL_ANSWER_ACTION)[-1].lstrip()
+                    if len(answer) > streamed:
+                        run_manager.on_text(answer[streamed:], final_answer=True)
+                        streamed = len(answer)
+                continue
+
+            # an action is complete once the LLM goes on to a Thought, Action or Observation,
+            # as its input may span several lines
+            complete = [m for m in matches if m.end() < len(text)]
+            for match in complete[len(started):]:
+                started.append(self._start(*_parse_tool_call(match)))
+            if complete and OBSERVATION_REGEX.match(text, complete[-1].end()):
+                text = text[: complete[-1].end()]
+                if hasattr(chunks, "close"):
+                    chunks.close()
+                break
+
+        output = self.parse(text)
+        if isinstance(output, AgentFinish) or not self.tools:
+            return output
+        actions = []
+        for i, action in enumerate(output):
+            if i < len(started) and started[i][2] is not None:
+                # the call is already running, so the action reports the input it was
+                # started with rather than running the tool again
+                tool, tool_input, call = started[i]
+            else:
+                tool, tool_input, call = self._start(action.tool, action.tool_input)
+            actions.append(
+                StartedAgentAction(
+                    tool=tool, tool_input=tool_input, log=action.log, tool_call=call
+                )
+            )
+        return actions
+
+    def _start(self, tool: str, tool_input: str) -> Tuple[str, str, Optional[ToolCall]]:
+        call = start_tool(self.tools[tool], tool_input) if tool in self.tools else None
+        return tool, tool_input, call
+
+    @property
+    def _type(self) -> str:
+        return "react-streaming"
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """AgentExecutor that runs the tool calls of an agent step concurrently.
+
+    Each call has its own timeout, counted from when it starts, after which the agent
+    observes that the tool did not respond. Callbacks are fired on the calling thread (or
+    event loop, with `ainvoke`/`astream`), in the order of the actions, as the results
+    are collected.
+    """
+
+    tool_timeout: float = 30.0
+    """Seconds to wait for a tool call."""
+    tool_timeouts: Dict[str, float] = {}
+    """Timeouts of specific tools, by tool name."""
+
+    def _iter_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Iterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        # _perform_agent_action only starts the calls, so that they all run at once
+        started = []
+        for output in super()._iter_next_step(
+            name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+        ):
+            if isinstance(output, AgentStep) and isinstance(output.observation, ToolCall):
+                started.append(output)
+            else:
+                yield output
+        for step in started:
+            yield self._wait_for_tool(name_to_tool_map, color_mapping, step, run_manager)
+
+    def _perform_agent_action(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> AgentStep:
+        """Returns a step whose observation is the ToolCall."""
+        if agent_action.tool not in name_to_tool_map:
+            return super()._perform_agent_action(
+                name_to_tool_map, color_mapping, agent_action, run_manager
+            )
+        # the output parser may have started the call already
+        tool_call = getattr(agent_action, "tool_call", None) or start_tool(
+            name_to_tool_map[agent_action.tool], agent_action.tool_input
+        )
+        return AgentStep(action=agent_action, observation=tool_call)
+
+    def _wait_for_tool(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        step: AgentStep,
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> AgentStep:
+        action = step.action
+        tool = name_to_tool_map[action.tool]
+        color = color_mapping[action.tool]
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        if tool.return_direct:
+            tool_run_kwargs["llm_prefix"] = ""
+
+        if run_manager:
+            run_manager.on_agent_action(action, color="green")
+        callback_manager = CallbackManager.configure(
+            run_manager.get_child() if run_manager else None,
+            tool.callbacks,
+            self.verbose,
+            local_tags=tool.tags,
+            local_metadata=tool.metadata,
+        )
+        tool_run_manager = callback_manager.on_tool_start(
+            {"name": tool.name, "description": tool.description},
+            str(action.tool_input),
+            color="green",
+            name=tool.name,
+            inputs=None if isinstance(action.tool_input, str) else action.tool_input,
+        )
+
+        timeout = self.tool_timeouts.get(tool.name, self.tool_timeout)
+        try:
+            observation = step.observation.result(timeout)
+        except TimeoutError:
+            observation = f"{tool.name} did not respond within {timeout:g} seconds"
+        except Exception as e:
+            tool_run_manager.on_tool_error(e)
+            raise
+        tool_run_manager.on_tool_end(observation, color=color, name=tool.name, **tool_run_kwargs)
+        return AgentStep(action=action, observation=observation)
+
+    async def _aiter_next_step(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        inputs: Dict[str, str],
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AsyncIterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        started = []
+        async for output in super()._aiter_next_step(
+            name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+        ):
+            if isinstance(output, AgentStep) and isinstance(output.observation, ToolCall):
+                started.append(output)
+            else:
+                yield output
+        for step in started:
+            yield await self._await_tool(name_to_tool_map, color_mapping, step, run_manager)
+
+    async def _aperform_agent_action(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        agent_action: AgentAction,
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AgentStep:
+        """Returns a step whose observation is the ToolCall."""
+        if agent_action.tool not in name_to_tool_map:
+            return await super()._aperform_agent_action(
+                name_to_tool_map, color_mapping, agent_action, run_manager
+            )
+        tool_call = getattr(agent_action, "tool_call", None) or start_tool(
+            name_to_tool_map[agent_action.tool], agent_action.tool_input
+        )
+        return AgentStep(action=agent_action, observation=tool_call)
+
+    async def _await_tool(
+        self,
+        name_to_tool_map: Dict[str, BaseTool],
+        color_mapping: Dict[str, str],
+        step: AgentStep,
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> AgentStep:
+        """Async counterpart of _wait_for_tool."""
+        action = step.action
+        tool = name_to_tool_map[action.tool]
+        color = color_mapping[action.tool]
+        tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+        if tool.return_direct:
+            tool_run_kwargs["llm_prefix"] = ""
+
+        if run_manager:
+            await run_manager.on_agent_action(action, color="green")
+        callback_manager = AsyncCallbackManager.configure(
+            run_manager.get_child() if run_manager else None,
+            tool.callbacks,
+            self.verbose,
+            local_tags=tool.tags,
+            local_metadata=tool.metadata,
+        )
+        tool_run_manager = await callback_manager.on_tool_start(
+            {"name": tool.name, "description": tool.description},
+            str(action.tool_input),
+            color="green",
+            name=tool.name,
+            inputs=None if isinstance(action.tool_input, str) else action.tool_input,
+        )
+
+        timeout = self.tool_timeouts.get(tool.name, self.tool_timeout)
+        try:
+            observation = await step.observation.aresult(timeout)
+        except TimeoutError:
+            observation = f"{tool.name} did not respond within {timeout:g} seconds"
+        except Exception as e:
+            await tool_run_manager.on_tool_error(e)
+            raise
+        await tool_run_manager.on_tool_end(
+            observation, color=color, name=tool.name, **tool_run_kwargs
+        )
+        return AgentStep(action=action, observation=observation)
+
 
 def create_react_agent(
     llm: BaseLanguageModel,
@@ -23,6 +398,7 @@ def create_react_agent(
     prompt: BasePromptTemplate,
     *,
     stop_sequence: Union[bool, List[str]] = True,
+    start_tools: bool = False,
 ) -> Runnable:
     """Create an agent that uses ReAct prompting.
     (https://api.python.langchain.com/en/latest/_modules/langchain/agents/react/agent.html#create_react_agent)
@@ -31,6 +407,9 @@ def create_react_agent(
         llm: LLM to use as the agent.
         tools: Tools this agent has access to.
         prompt: The prompt to use. See Prompt section below for more.
+            Several independent actions can be taken in one step, with one
+            Action/Action Input pair each. Run the agent with a ParallelAgentExecutor
+            to call their tools concurrently.
         output_parser: AgentOutputParser for parse the LLM output.
         stop_sequence: bool or list of str.
             If True, adds a stop token of "Observation:" to avoid hallucinates.
@@ -38,12 +417,17 @@ def create_react_agent(
             If a list of str, uses the provided list as the stop tokens.
 
             Default is True. You may to set this to False if the LLM you are using
-            does not support stop sequences.
+            does not support stop sequences. The output is parsed as it is
+            streamed, and the generation is cancelled if the LLM writes an
+            observation after its actions.
+        start_tools: Whether to start the tool calls while the LLM output is streamed,
+            as soon as each `Action Input:` is complete. This requires a
+            ParallelAgentExecutor, which waits for the started calls.
 
     Returns:
         A Runnable sequence representing an agent. It takes as input all the same input
-        variables as the prompt passed in does. It returns as output either an
-        AgentAction or AgentFinish.
+        variables as the prompt passed in does. It returns as output either a list of
+        AgentActions or an AgentFinish.
 
     Examples:
 
@@ -131,7 +515,7 @@ def create_react_agent(
         )
         | prompt
         | llm_with_stop
-        | ReActSingleInputOutputParser()
+        | ReActStreamingOutputParser(tools={t.name: t for t in tools} if start_tools else {})
     )
     return agent
 
@@ -0,0 +1,216 @@
+"""
+Calibrates CPU inference parameters of GGUF models on the current machine.
+
+For each candidate thread count and batch size, a short pass measures prompt-eval and
+decode throughput. The settings with the lowest time for a reference request are saved
+as a profile, which `src.llms` applies to models built with the same path and backend.
+
+    python -m src.autotune models/llama-2-7b-chat.Q4_K_M.gguf --backend ctransformers
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import time
+from typing import Optional
+
+from loguru import logger
+
+from src import CFG
+from src.workers import available_cores
+
+BATCH_SIZES = (8, 32, 128, 512)
+# reference request used to score settings
+PROMPT_TOKENS = 512
+DECODE_TOKENS = 128
+CALIBRATION_TEXT = (
+    "The annual report describes the portfolio, the distribution per unit, the net "
+    "property income and the aggregate leverage of the trust for the financial year. "
+)
+
+
+def profile_path(model_path: str, backend: str) -> str:
+    name = os.path.basename(model_path)
+    return os.path.join(CFG.AUTOTUNE.PROFILE_DIR, f"{name}.{backend}.json")
+
+
+def load_profile(model_path: str, backend: str) -> dict:
+    """Returns the tuned config of the model, or {} if there is none for this machine."""
+    path = profile_path(model_path, backend)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        profile = json.load(f)
+    if profile["host"] != get_host():
+        logger.warning(f"Ignoring {path}, which was tuned on another machine")
+        return {}
+    return profile["config"]
+
+
+def get_host() -> dict:
+    return {"machine": platform.machine(), "cpu_count": os.cpu_count()}
+
+
+def thread_candidates() -> list[int]:
+    cores = len(available_cores())
+    return sorted({max(1, cores * k // 4) for k in range(1, 5)} | {1})
+
+
+def can_mlock(model_path: str) -> bool:
+    """Whether the memlock limit allows locking the whole model in RAM."""
+    soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    return soft == resource.RLIM_INFINITY or soft >= os.path.getsize(model_path)
+
+
+def reference_seconds(prompt_tps: float, decode_tps: float) -> float:
+    return PROMPT_TOKENS / prompt_tps + DECODE_TOKENS / decode_tps
+
+
+def calibration_tokens(tokenize, context_length: int) -> list[int]:
+    n_tokens = min(PROMPT_TOKENS, context_length - DECODE_TOKENS)
+    text = CALIBRATION_TEXT * (n_tokens // 20 + 1)
+    return tokenize(text)[:n_tokens]
+
+
+def tune_ctransformers(model_path: str, context_length: int) -> tuple[dict, list[dict]]:
+    """ctransformers takes threads and batch size per call, so the model loads once."""
+    from ctransformers import AutoModelForCausalLM
+
+    llm = AutoModelForCausalLM.from_pretrained(model_path, context_length=context_length)
+    tokens = calibration_tokens(llm.tokenize, context_length)
+
+    def measure_prompt(threads: int, batch_size: int) -> dict:
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(tokens, batch_size=batch_size, threads=threads)
+        tps = len(tokens) / (time.perf_counter() - start)
+        return {"threads": threads, "batch_size": batch_size, "prompt_tokens_per_s": tps}
+
+    def measure_decode(threads: int) -> dict:
+        # the batch size only applies to prompt eval, so decode is measured once per
+        # thread count
+        llm.reset()
+        llm.eval(tokens[:8], threads=threads)
+        start = time.perf_counter()
+        for _ in range(DECODE_TOKENS):
+            llm.eval([llm.sample()], threads=threads)
+        tps = DECODE_TOKENS / (time.perf_counter() - start)
+        return {"threads": threads, "decode_tokens_per_s": tps}
+
+    prompt_results = []
+    for threads in thread_candidates():
+        for batch_size in BATCH_SIZES:
+            prompt_results.append(measure_prompt(threads, batch_size))
+            logger.info(prompt_results[-1])
+    decode_tps = {}
+    decode_results = []
+    for threads in thread_candidates():
+        decode_results.append(measure_decode(threads))
+        decode_tps[threads] = decode_results[-1]["decode_tokens_per_s"]
+        logger.info(decode_results[-1])
+
+    # one thread count serves both prompt eval and decode
+    best = min(
+        prompt_results,
+        key=lambda r: reference_seconds(r["prompt_tokens_per_s"], decode_tps[r["threads"]]),
+    )
+    config = {
+        "threads": best["threads"],
+        "batch_size": best["batch_size"],
+        # mmap shares the weights between processes through the page cache
+        "mmap": True,
+        "mlock": can_mlock(model_path),
+    }
+    return config, prompt_results + decode_results
+
+
+def tune_llamacpp(model_path: str, context_length: int) -> tuple[dict, list[dict]]:
+    """llama.cpp takes separate thread counts for prompt eval and decode, which are tuned
+    separately. The context is created once with the largest batch size."""
+    import llama_cpp
+    from llama_cpp import Llama
+
+    llm = Llama(model_path, n_ctx=context_length, n_batch=max(BATCH_SIZES), verbose=False)
+    tokens = calibration_tokens(lambda text: llm.tokenize(text.encode()), context_length)
+
+    def measure_prompt(threads: int, batch_size: int) -> dict:
+        llama_cpp.llama_set_n_threads(llm.ctx, threads, threads)
+        llm.n_batch = batch_size
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(tokens)
+        tps = len(tokens) / (time.perf_counter() - start)
+        return {"threads_batch": threads, "n_batch": batch_size, "prompt_tokens_per_s": tps}
+
+    def measure_decode(threads: int) -> dict:
+        llama_cpp.llama_set_n_threads(llm.ctx, threads, threads)
+        llm.reset()
+        llm.eval(tokens[:8])
+        start = time.perf_counter()
+        for _ in range(DECODE_TOKENS):
+            llm.eval([llm.sample()])
+        tps = DECODE_TOKENS / (time.perf_counter() - start)
+        return {"threads": threads, "decode_tokens_per_s": tps}
+
+    prompt_results = []
+    for threads in thread_candidates():
+        for batch_size in BATCH_SIZES:
+            prompt_results.append(measure_prompt(threads, batch_size))
+            logger.info(prompt_results[-1])
+    decode_results = []
+    for threads in thread_candidates():
+        decode_results.append(measure_decode(threads))
+        logger.info(decode_results[-1])
+
+    best_prompt = max(prompt_results, key=lambda r: r["prompt_tokens_per_s"])
+    best_decode = max(decode_results, key=lambda r: r["decode_tokens_per_s"])
+    config = {
+        "n_threads": best_decode["threads"],
+        "n_batch": best_prompt["n_batch"],
+        "use_mmap": True,
+        "use_mlock": can_mlock(model_path),
+        "model_kwargs": {"n_threads_batch": best_prompt["threads_batch"]},
+    }
+    return config, prompt_results + decode_results
+
+
+def autotune(model_path: str, backend: str, context_length: Optional[int] = None) -> dict:
+    """Tunes the model and saves its profile."""
+    context_length = context_length or CFG.LLM_CONFIG.CONTEXT_LENGTH
+    logger.info(f"Tuning {model_path} with {backend} ...")
+    if backend == "ctransformers":
+        config, results = tune_ctransformers(model_path, context_length)
+    else:
+        config, results = tune_llamacpp(model_path, context_length)
+
+    profile = {
+        "model_path": model_path,
+        "backend": backend,
+        "host": get_host(),
+        "config": config,
+        "results": results,
+    }
+    path = profile_path(model_path, backend)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    logger.info(f"Saved {config} to {path}")
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("model_paths", type=str, nargs="+")
+    parser.add_argument(
+        "--backend", type=str, choices=["ctransformers", "llamacpp"], default="ctransformers"
+    )
+    parser.add_argument("--context-length", type=int)
+    args = parser.parse_args()
+    for model_path in args.model_paths:
+        autotune(model_path, args.backend, args.context_length)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Local sentence embeddings with dynamic batching.
+
+Texts from concurrent requests are collected for up to `max_wait` seconds, or until
+`max_batch_size` texts are waiting, and encoded in one forward pass. Vectors are cached
+by a hash of the text, so repeated chunks of a document are embedded only once.
+"""
+
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from src import metrics
+
+
+class EmbeddingBatcher:
+    """Embeds texts with a sentence-transformers model.
+
+    Args:
+        model_name: Name or path of the sentence-transformers model.
+        max_batch_size: Maximum number of texts encoded in one forward pass.
+        max_wait: Seconds to wait for more texts before encoding a partial batch.
+        cache_size: Maximum number of cached vectors.
+        device: Torch device of the model.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_batch_size: int = 64,
+        max_wait: float = 0.01,
+        cache_size: int = 20000,
+        device: str = "cpu",
+    ) -> None:
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.device = device
+        self.model = None
+        # hash -> (vector, number of tokens)
+        self._cache: OrderedDict[str, tuple[np.ndarray, int]] = OrderedDict()
+        # texts waiting to be encoded, and the futures of all texts not yet cached
+        self._waiting: OrderedDict[str, str] = OrderedDict()
+        self._futures: dict[str, asyncio.Future] = {}
+        self._lock = asyncio.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def hash(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+
+        logger.info(f"Loading embedding model {self.model_name} ...")
+        return SentenceTransformer(self.model_name, device=self.device)
+
+    async def embed(self, texts: list[str]) -> tuple[list[np.ndarray], int]:
+        """Returns the vector of each text and the total number of tokens."""
+        if self.model is None:
+            async with self._lock:
+                if self.model is None:
+                    self.model = await asyncio.to_thread(self._load)
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+        loop = asyncio.get_running_loop()
+        pending = []
+        for text in texts:
+            key = self.hash(text)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                pending.append(self._cache[key])
+                metrics.EMBEDDED_TEXTS.inc(cached="true")
+                continue
+            metrics.EMBEDDED_TEXTS.inc(cached="false")
+            if key not in self._futures:
+                self._futures[key] = loop.create_future()
+                self._waiting[key] = text
+            pending.append(self._futures[key])
+        if self._waiting:
+            self._wakeup.set()
+
+        results = [
+            await asyncio.shield(entry) if isinstance(entry, asyncio.Future) else entry
+            for entry in pending
+        ]
+        return [vector for vector, _ in results], sum(n for _, n in results)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # let concurrent requests join the batch
+            if len(self._waiting) < self.max_batch_size:
+                await asyncio.sleep(self.max_wait)
+
+            while self._waiting:
+                batch = []
+                while self._waiting and len(batch) < self.max_batch_size:
+                    batch.append(self._waiting.popitem(last=False))
+                keys = [key for key, _ in batch]
+                metrics.EMBEDDING_BATCH_SIZE.observe(len(batch))
+                try:
+                    vectors, lengths = await asyncio.to_thread(
+                        self._encode, [text for _, text in batch]
+                    )
+                except Exception as e:
+                    for key in keys:
+                        self._futures.pop(key).set_exception(e)
+                    continue
+
+                for key, vector, n in zip(keys, vectors, lengths):
+                    self._cache[key] = (vector, n)
+                    self._futures.pop(key).set_result((vector, n))
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+    def _encode(self, texts: list[str]) -> tuple[np.ndarray, list[int]]:
+        vectors = self.model.encode(
+            texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True
+        )
+        lengths = [len(ids) for ids in self.model.tokenizer(texts)["input_ids"]]
+        return vectors.astype(np.float32), lengths
@@ -0,0 +1,639 @@
+"""
+Continuous-batching generation engine used by serve.py.
+
+Each slot owns one model context. Weights are memory-mapped from the same GGUF file, so
+extra slots only cost their KV cache. The scheduler admits waiting requests into free
+slots, highest priority first, steps every active sequence one token at a time and frees
+the slot as soon as the sequence finishes.
+
+A finished slot keeps its KV cache. The next request of the same session (or the one
+sharing the longest token prefix) is routed back to it, so only the new suffix of a
+multi-turn prompt is evaluated. When all slots hold cached state, the least recently
+used one is evicted.
+"""
+
+import asyncio
+import codecs
+import heapq
+import itertools
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Optional
+
+from loguru import logger
+
+from src import metrics
+
+
+@dataclass
+class GenerationParams:
+    max_new_tokens: int = 512
+    temperature: float = 0.2
+    repetition_penalty: float = 1.1
+    # generation ends as soon as one of these strings is produced; it is not returned
+    stop: list[str] = field(default_factory=list)
+
+
+class CTransformersBackend:
+    """A single ctransformers model context."""
+
+    def __init__(self, model_path: str, config: Optional[dict] = None) -> None:
+        from ctransformers import AutoModelForCausalLM
+
+        self.model = AutoModelForCausalLM.from_pretrained(model_path, **(config or {}))
+        self.threads: Optional[int] = None
+
+    @property
+    def context_length(self) -> int:
+        return self.model.context_length
+
+    def tokenize(self, text: str) -> list[int]:
+        return self.model.tokenize(text)
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return self.model.detokenize(tokens)
+
+    def token_bytes(self, token: int) -> bytes:
+        return self.model.detokenize([token], decode=False)
+
+    def prefill(self, tokens: list[int]) -> list[int]:
+        """Returns the suffix of tokens that is not yet evaluated in this context."""
+        return list(self.model.prepare_inputs_for_generation(tokens, reset=True))
+
+    def set_threads(self, threads: int) -> None:
+        self.threads = threads
+
+    def eval(self, tokens: list[int]) -> None:
+        self.model.eval(tokens, threads=self.threads)
+
+    def sample(self, params: GenerationParams) -> int:
+        return self.model.sample(
+            temperature=params.temperature,
+            repetition_penalty=params.repetition_penalty,
+        )
+
+    def is_eos(self, token: int) -> bool:
+        return self.model.is_eos_token(token)
+
+
+class LlamaCppBackend:
+    """A single llama.cpp model context."""
+
+    def __init__(self, model_path: str, config: Optional[dict] = None) -> None:
+        from llama_cpp import Llama
+
+        self.model = Llama(model_path, verbose=False, **(config or {}))
+
+    @property
+    def context_length(self) -> int:
+        return self.model.n_ctx()
+
+    def tokenize(self, text: str) -> list[int]:
+        return self.model.tokenize(text.encode())
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return self.model.detokenize(tokens).decode(errors="ignore")
+
+    def token_bytes(self, token: int) -> bytes:
+        return self.model.detokenize([token])
+
+    def prefill(self, tokens: list[int]) -> list[int]:
+        """Returns the suffix of tokens that is not yet evaluated in this context."""
+        n = min(len(tokens) - 1, self.model.n_tokens)
+        i = 0
+        while i < n and tokens[i] == self.model.input_ids[i]:
+            i += 1
+        # the next eval drops the KV cache beyond the kept prefix
+        self.model.n_tokens = i
+        return tokens[i:]
+
+    def set_threads(self, threads: int) -> None:
+        import llama_cpp
+
+        if threads != self.model.n_threads:
+            llama_cpp.llama_set_n_threads(self.model.ctx, threads, threads)
+            self.model.n_threads = threads
+
+    def eval(self, tokens: list[int]) -> None:
+        self.model.eval(tokens)
+
+    def sample(self, params: GenerationParams) -> int:
+        return self.model.sample(
+            temp=params.temperature, repeat_penalty=params.repetition_penalty
+        )
+
+    def sample_at(self, position: int, params: GenerationParams) -> int:
+        """Samples the token following `position`, from the logits kept by `logits_all`."""
+        n_tokens = self.model.n_tokens
+        # sample() reads the logits and the penalty window up to n_tokens
+        self.model.n_tokens = position + 1
+        try:
+            return self.sample(params)
+        finally:
+            self.model.n_tokens = n_tokens
+
+    def rollback(self, n_tokens: int) -> None:
+        """Forgets the tokens evaluated beyond the first n_tokens."""
+        self.model.n_tokens = n_tokens
+
+    def is_eos(self, token: int) -> bool:
+        return token == self.model.token_eos()
+
+
+class SpeculativeBackend:
+    """Target model context whose next tokens are proposed by a small draft model and
+    verified in one batched forward pass.
+
+    The target samples every position itself and the longest run of drafted tokens that
+    matches its samples is kept, so outputs follow the target model's distribution; the
+    draft only changes speed. The draft must share the vocabulary of the target.
+
+    Args:
+        target: LlamaCppBackend created with `logits_all=True`.
+        draft: Backend of the draft model.
+        num_draft_tokens: Tokens proposed per step.
+        name: Model name used to label metrics.
+    """
+
+    def __init__(self, target, draft, num_draft_tokens: int = 4, name: str = "") -> None:
+        self.target = target
+        self.draft = draft
+        self.num_draft_tokens = num_draft_tokens
+        self.name = name
+        # tokens evaluated by the target
+        self.tokens: list[int] = []
+
+    @property
+    def context_length(self) -> int:
+        return self.target.context_length
+
+    def tokenize(self, text: str) -> list[int]:
+        return self.target.tokenize(text)
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return self.target.detokenize(tokens)
+
+    def token_bytes(self, token: int) -> bytes:
+        return self.target.token_bytes(token)
+
+    def is_eos(self, token: int) -> bool:
+        return self.target.is_eos(token)
+
+    def set_threads(self, threads: int) -> None:
+        self.target.set_threads(threads)
+        self.draft.set_threads(threads)
+
+    def prefill(self, tokens: list[int]) -> list[int]:
+        suffix = self.target.prefill(tokens)
+        self.tokens = tokens[: len(tokens) - len(suffix)]
+        return suffix
+
+    def step(self, pending: list[int], params: GenerationParams) -> list[int]:
+        """Evaluates the pending tokens and returns one or more next tokens."""
+        context = self.tokens + pending
+        self.draft.eval(self.draft.prefill(context))
+        budget = min(self.num_draft_tokens, self.context_length - len(context) - 1)
+        drafted = []
+        while len(drafted) < budget:
+            token = self.draft.sample(params)
+            if self.draft.is_eos(token):
+                break
+            drafted.append(token)
+            if len(drafted) < budget:
+                self.draft.eval([token])
+
+        self.target.eval(pending + drafted)
+        # the logits at the last context position predict the first drafted token
+        start = len(context) - 1
+        tokens = []
+        for i, token in enumerate(drafted):
+            tokens.append(self.target.sample_at(start + i, params))
+            if tokens[-1] != token:
+                break
+        else:
+            tokens.append(self.target.sample_at(start + len(drafted), params))
+
+        n_accepted = len(tokens) - 1
+        self.target.rollback(len(context) + n_accepted)
+        self.tokens = context + tokens[:-1]
+        metrics.DRAFT_TOKENS.inc(len(drafted), model=self.name)
+        metrics.ACCEPTED_DRAFT_TOKENS.inc(n_accepted, model=self.name)
+        return tokens
+
+
+class FakeBackend:
+    """Deterministic stand-in for a model context, for benchmarking the serving layer
+    without model weights. Tokens are bytes; evaluation sleeps for a fixed time per token.
+
+    Args:
+        prompt_token_seconds: Time to evaluate one prompt token.
+        decode_token_seconds: Time to generate one token.
+        context_length: Maximum context length.
+    """
+
+    EOS = 256
+    WORDS = [b"lorem", b"ipsum", b"dolor", b"sit", b"amet", b"consectetur", b"adipiscing"]
+
+    def __init__(
+        self,
+        prompt_token_seconds: float = 0.0005,
+        decode_token_seconds: float = 0.02,
+        context_length: int = 2048,
+    ) -> None:
+        self.prompt_token_seconds = prompt_token_seconds
+        self.decode_token_seconds = decode_token_seconds
+        self.context_length = context_length
+        self.tokens: list[int] = []
+
+    def tokenize(self, text: str) -> list[int]:
+        return list(text.encode())
+
+    def detokenize(self, tokens: list[int]) -> str:
+        return bytes(t for t in tokens if t != self.EOS).decode(errors="ignore")
+
+    def token_bytes(self, token: int) -> bytes:
+        return bytes([token])
+
+    def prefill(self, tokens: list[int]) -> list[int]:
+        n = min(len(tokens) - 1, len(self.tokens))
+        i = 0
+        while i < n and tokens[i] == self.tokens[i]:
+            i += 1
+        self.tokens = self.tokens[:i]
+        return tokens[i:]
+
+    def eval(self, tokens: list[int]) -> None:
+        if len(tokens) == 1:
+            time.sleep(self.decode_token_seconds)
+        else:
+            time.sleep(self.prompt_token_seconds * len(tokens))
+        self.tokens.extend(tokens)
+
+    def sample(self, params: GenerationParams) -> int:
+        # cycle through the words, seeded by the prompt so that outputs are deterministic
+        n = len(self.tokens)
+        word = self.WORDS[(sum(self.tokens[:64]) + n // 8) % len(self.WORDS)] + b" "
+        return word[n % len(word)]
+
+    def is_eos(self, token: int) -> bool:
+        return token == self.EOS
+
+
+class Sequence:
+    """A single generation request tracked by the engine."""
+
+    def __init__(
+        self,
+        prompt: str,
+        prompt_tokens: list[int],
+        params: GenerationParams,
+        stream: bool = False,
+        session_id: Optional[str] = None,
+    ) -> None:
+        self.id = str(uuid.uuid4())
+        self.prompt = prompt
+        self.prompt_tokens = prompt_tokens
+        self.params = params
+        self.session_id = session_id
+        # number of prompt tokens whose KV state was reused from a previous request
+        self.cached_tokens = 0
+        self.output_tokens: list[int] = []
+        self.text = ""
+        # number of characters of text already sent to the stream
+        self._sent = 0
+        self.finish_reason: Optional[str] = None
+        self.cancelled = False
+        self.future: Future = Future()
+        self.arrival_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.last_token_time: Optional[float] = None
+        # tokens to be evaluated on the next step
+        self._pending: list[int] = []
+        # tokens may end in the middle of a multi-byte character
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        # per-request queue of text deltas, fed from the scheduler thread
+        self._loop = asyncio.get_running_loop() if stream else None
+        self.queue: Optional[asyncio.Queue] = asyncio.Queue() if stream else None
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    def _append(self, data: bytes) -> bool:
+        """Appends generated bytes to text. Returns True if a stop string is reached."""
+        start = len(self.text)
+        self.text += self._decoder.decode(data)
+        stop = self.params.stop
+        if not stop:
+            self._flush(len(self.text))
+            return False
+
+        # a stop string may span several tokens
+        longest = max(map(len, stop))
+        i = min(
+            (j for s in stop if (j := self.text.find(s, max(0, start - longest + 1))) != -1),
+            default=-1,
+        )
+        if i != -1:
+            self.text = self.text[:i]
+            self._flush(len(self.text))
+            return True
+
+        # hold back the tail of text that may still become a stop string
+        held = max(
+            (n for s in stop for n in range(len(s) - 1, 0, -1) if self.text.endswith(s[:n])),
+            default=0,
+        )
+        self._flush(len(self.text) - held)
+        return False
+
+    def _flush(self, end: int) -> None:
+        if self.queue is not None and end > self._sent:
+            delta = self.text[self._sent:end]
+            self._loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+        self._sent = max(self._sent, end)
+
+    def _finish(self, error: Optional[BaseException] = None) -> None:
+        self._flush(len(self.text))
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(self)
+        if self.queue is not None:
+            # signal the end of stream
+            self._loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+class Slot:
+    def __init__(self, index: int, backend) -> None:
+        self.index = index
+        self.backend = backend
+        self.sequence: Optional[Sequence] = None
+        self.busy = False
+        # tokens held in the KV cache of this context, and who they belong to
+        self.tokens: list[int] = []
+        self.session_id: Optional[str] = None
+        self.last_used = 0.0
+
+    def common_prefix(self, tokens: list[int]) -> int:
+        n = min(len(tokens), len(self.tokens))
+        i = 0
+        while i < n and tokens[i] == self.tokens[i]:
+            i += 1
+        return i
+
+
+class Engine:
+    """Schedules sequences onto a fixed number of model contexts.
+
+    Args:
+        backend_factory: Callable that creates one model context.
+        max_batch_size: Maximum number of sequences decoded concurrently.
+        num_slots: Number of contexts to create. Contexts beyond `max_batch_size` only
+            hold cached KV state of idle sessions. Defaults to `max_batch_size`.
+        num_threads: Threads shared by the active sequences. Each context is stepped
+            separately, so a single sequence gets all of them and concurrent sequences
+            split them evenly. Defaults to the threads each backend was created with.
+        name: Model name used to label metrics.
+    """
+
+    def __init__(
+        self,
+        backend_factory: Callable,
+        max_batch_size: int = 4,
+        num_slots: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        name: str = "",
+    ) -> None:
+        self.name = name
+        self.num_threads = num_threads
+        num_slots = max(num_slots or 0, max_batch_size)
+        logger.info(f"Loading {num_slots} model context(s) ...")
+        self.slots = [Slot(i, backend_factory()) for i in range(num_slots)]
+        self.max_batch_size = max_batch_size
+        self.tokenizer = self.slots[0].backend
+        # heap of (priority, arrival order, sequence)
+        self._waiting: list[tuple[int, int, Sequence]] = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=max_batch_size)
+        self._thread = threading.Thread(target=self._run, name="engine-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def num_active(self) -> int:
+        return sum(slot.sequence is not None for slot in self.slots)
+
+    @property
+    def num_sessions(self) -> int:
+        """Number of chat sessions holding KV state in a context."""
+        return len({slot.session_id for slot in self.slots if slot.session_id is not None})
+
+    def submit(
+        self,
+        prompt: str,
+        params: Optional[GenerationParams] = None,
+        stream: bool = False,
+        session_id: Optional[str] = None,
+        priority: int = 0,
+    ) -> Sequence:
+        """Queues a prompt for generation and returns its sequence. Waiting sequences are
+        admitted in order of priority (lower first), then of arrival."""
+        seq = Sequence(
+            prompt,
+            self.tokenizer.tokenize(prompt),
+            params or GenerationParams(),
+            stream=stream,
+            session_id=session_id,
+        )
+        with self._lock:
+            heapq.heappush(self._waiting, (priority, next(self._counter), seq))
+        self._wakeup.set()
+        return seq
+
+    async def generate(
+        self,
+        prompt: str,
+        params: Optional[GenerationParams] = None,
+        session_id: Optional[str] = None,
+        priority: int = 0,
+    ) -> Sequence:
+        """Submits a prompt and waits until its sequence finishes."""
+        seq = self.submit(prompt, params, session_id=session_id, priority=priority)
+        await asyncio.wrap_future(seq.future)
+        return seq
+
+    async def stream(
+        self,
+        prompt: str,
+        params: Optional[GenerationParams] = None,
+        session_id: Optional[str] = None,
+        priority: int = 0,
+    ) -> AsyncIterator[str]:
+        """Submits a prompt and yields its text deltas as they are generated."""
+        seq = self.submit(prompt, params, stream=True, session_id=session_id, priority=priority)
+        async for delta in self.iter_text(seq):
+            yield delta
+
+    async def iter_text(self, seq: Sequence) -> AsyncIterator[str]:
+        """Yields text deltas of a sequence submitted with `stream=True`. The sequence is
+        cancelled if the consumer stops iterating early, e.g. when the client disconnects."""
+        try:
+            while (delta := await seq.queue.get()) is not None:
+                yield delta
+        finally:
+            if not seq.finished:
+                self.cancel(seq)
+        # re-raise generation errors
+        seq.future.result()
+
+    def cancel(self, seq: Sequence) -> None:
+        """Stops generating a sequence and frees its slot."""
+        with self._lock:
+            entry = next((e for e in self._waiting if e[2] is seq), None)
+            if entry is not None:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                seq.finish_reason = "cancelled"
+                self._record(seq)
+                seq._finish()
+                return
+        # active sequences are stopped on their next step
+        seq.cancelled = True
+
+    def shutdown(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        # release the model contexts
+        self.slots = []
+        self.tokenizer = None
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopped:
+                return
+
+            with self._lock:
+                self._admit()
+                ready = [s for s in self.slots if s.sequence is not None and not s.busy]
+                for slot in ready:
+                    slot.busy = True
+                threads = self.num_threads and max(1, self.num_threads // max(1, self.num_active))
+
+            for slot in ready:
+                future = self._executor.submit(self._step, slot, threads)
+                future.add_done_callback(lambda f, slot=slot: self._on_step_done(slot, f))
+
+    def _admit(self) -> None:
+        """Moves waiting sequences into free slots, highest priority first."""
+        while self._waiting and self.num_active < self.max_batch_size:
+            seq = self._waiting[0][2]
+            slot = self._select_slot(seq)
+            if slot is None:
+                return
+            heapq.heappop(self._waiting)
+            seq._pending = slot.backend.prefill(seq.prompt_tokens)
+            seq.cached_tokens = len(seq.prompt_tokens) - len(seq._pending)
+            slot.sequence = seq
+            metrics.QUEUE_TIME.observe(time.perf_counter() - seq.arrival_time, model=self.name)
+
+    def _select_slot(self, seq: Sequence) -> Optional[Slot]:
+        """Picks the free slot holding the session, else the longest shared prefix,
+        else the least recently used one."""
+        free = [s for s in self.slots if s.sequence is None and not s.busy]
+        if not free:
+            return None
+        return max(
+            free,
+            key=lambda s: (
+                seq.session_id is not None and s.session_id == seq.session_id,
+                s.common_prefix(seq.prompt_tokens),
+                -s.last_used,
+            ),
+        )
+
+    def _step(self, slot: Slot, threads: Optional[int] = None) -> None:
+        """Evaluates pending tokens of the slot's sequence and samples the next token, or
+        several with speculative decoding."""
+        seq, backend = slot.sequence, slot.backend
+        if seq.cancelled:
+            seq.finish_reason = "cancelled"
+            return
+
+        if threads:
+            backend.set_threads(threads)
+        if isinstance(backend, SpeculativeBackend):
+            tokens = backend.step(seq._pending, seq.params)
+        else:
+            backend.eval(seq._pending)
+            tokens = [backend.sample(seq.params)]
+
+        now = time.perf_counter()
+        if seq.first_token_time is None:
+            seq.first_token_time = now
+            metrics.TIME_TO_FIRST_TOKEN.observe(now - seq.arrival_time, model=self.name)
+        else:
+            latency = (now - seq.last_token_time) / len(tokens)
+            for _ in tokens:
+                metrics.INTER_TOKEN_LATENCY.observe(latency, model=self.name)
+        seq.last_token_time = now
+
+        for token in tokens:
+            if backend.is_eos(token):
+                seq.finish_reason = "stop"
+                return
+
+            seq.output_tokens.append(token)
+            seq._pending = [token]
+            if seq._append(backend.token_bytes(token)):
+                seq.finish_reason = "stop"
+            elif len(seq.output_tokens) >= seq.params.max_new_tokens:
+                seq.finish_reason = "length"
+            elif len(seq.prompt_tokens) + len(seq.output_tokens) >= backend.context_length:
+                seq.finish_reason = "length"
+            if seq.finished:
+                return
+
+    def _on_step_done(self, slot: Slot, future: Future) -> None:
+        seq = slot.sequence
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Generation failed for {seq.id}: {error}")
+            seq.finish_reason = "error"
+
+        if seq.finished:
+            with self._lock:
+                slot.sequence = None
+                slot.tokens = seq.prompt_tokens + seq.output_tokens
+                slot.session_id = seq.session_id
+                slot.last_used = time.perf_counter()
+            self._record(seq)
+            seq._finish(error)
+
+        slot.busy = False
+        self._wakeup.set()
+
+    def _record(self, seq: Sequence) -> None:
+        metrics.REQUESTS.inc(model=self.name, finish_reason=seq.finish_reason)
+        metrics.PROMPT_TOKENS.inc(len(seq.prompt_tokens), model=self.name)
+        metrics.CACHED_PROMPT_TOKENS.inc(seq.cached_tokens, model=self.name)
+        metrics.COMPLETION_TOKENS.inc(len(seq.output_tokens), model=self.name)
+        if len(seq.output_tokens) > 1:
+            elapsed = seq.last_token_time - seq.first_token_time
+            if elapsed > 0:
+                metrics.TOKENS_PER_SECOND.observe(
+                    (len(seq.output_tokens) - 1) / elapsed, model=self.name
+                )
@@ -1,26 +1,78 @@
 import base64
+import hashlib
 import os
 import tempfile
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from io import BytesIO
+from typing import Iterator
 
 import fitz
 import numpy as np
 from loguru import logger
-from PIL import Image
-
-
-def perform(func, filebytes, **kwargs):
-    """Wrapper function to perform func for bytes file."""
-    fh, temp_filename = tempfile.mkstemp()
+from PIL import Image, ImageOps
+
+
+# in-memory files of recent uploads, keyed by content hash
+MAX_MEMORY_FILES = 8
+_memory_files: OrderedDict[str, list] = OrderedDict()
+_memory_files_lock = threading.Lock()
+
+
+def perform(func, filebytes, stream: bool = False, **kwargs):
+    """Wrapper function to perform func for bytes file.
+
+    With stream=True, func is given the bytes as they are, for loaders that accept
+    streams, e.g. `lambda b: fitz.open(stream=b, filetype="pdf")`. Otherwise func is given
+    the path of an in-memory copy of the bytes, reused while the content is the same.
+    """
+    if stream:
+        return func(filebytes, **kwargs)
+    with memory_file(filebytes) as path:
+        return func(path, **kwargs)
+
+
+@contextmanager
+def memory_file(filebytes) -> Iterator[str]:
+    """Yields the path of a memfd (or tmpfs) file holding the bytes. Files are cached by
+    the sha256 of their content and the least recently used unused ones are closed."""
+    key = hashlib.sha256(filebytes).hexdigest()
+    with _memory_files_lock:
+        entry = _memory_files.get(key)
+        if entry is None:
+            entry = _memory_files[key] = [*_create_memory_file(filebytes), 0]
+        _memory_files.move_to_end(key)
+        entry[2] += 1
+        _evict_memory_files()
     try:
-        with open(temp_filename, "wb") as f:
-            f.write(filebytes)
-            f.flush()
-            return func(f.name, **kwargs)
+        yield entry[1]
     finally:
-        os.close(fh)
-        os.remove(temp_filename)
+        with _memory_files_lock:
+            entry[2] -= 1
+            _evict_memory_files()
+
+
+def _create_memory_file(filebytes) -> tuple[int, str]:
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("upload")
+        path = f"/proc/{os.getpid()}/fd/{fd}"
+    else:
+        fd, path = tempfile.mkstemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    view = memoryview(filebytes)
+    while view:
+        view = view[os.write(fd, view):]
+    return fd, path
+
+
+def _evict_memory_files() -> None:
+    idle = [key for key, (_, _, users) in _memory_files.items() if users == 0]
+    for key in idle[: max(0, len(_memory_files) - MAX_MEMORY_FILES)]:
+        fd, path, _ = _memory_files.pop(key)
+        os.close(fd)
+        if not path.startswith("/proc/"):
+            os.remove(path)
 
 
 def sleep(timeout, retry=3):
@@ -56,6 +108,21 @@ def encode_pil_image(image: Image.Image) -> str:
     return base64_bytes.decode("utf-8")
 
 
+def encode_image_url(image_bytes: bytes, max_size: int = 336, quality: int = 90) -> str:
+    """Encode an image as a data URL, downscaled so that its longer side is at most
+    max_size. Images that are already small enough are sent as they are."""
+    image = Image.open(BytesIO(image_bytes))
+    if max(image.size) <= max_size and image.format in ("JPEG", "PNG"):
+        mime, data = Image.MIME[image.format], image_bytes
+    else:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((max_size, max_size), Image.Resampling.BICUBIC)
+        buffered = BytesIO()
+        image.save(buffered, format="jpeg", quality=quality)
+        mime, data = "image/jpeg", buffered.getvalue()
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
 def encode_fitz_page(page: fitz.Page) -> str:
     """Encode a fitz page to base64 encoded string."""
     pix = page.get_pixmap()
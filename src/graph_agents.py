@@ -1,17 +1,22 @@
 import json
 import operator
+from concurrent.futures import TimeoutError
 from typing import Annotated, Sequence, TypedDict
 
 from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_core.messages import BaseMessage, FunctionMessage
+from langchain_core.messages import BaseMessage, FunctionMessage, ToolMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolInvocation, ToolExecutor
 
+from src.agents import ToolCall
+
 # Tool template: see
 # https://api.python.langchain.com/en/latest/_modules/langchain_community/tools/tavily_search/tool.html
 tools = [TavilySearchResults(max_results=1)]
 tool_executor = ToolExecutor(tools)
+# seconds to wait for each tool call
+TOOL_TIMEOUT = 30
 
 model = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0, streaming=False)
 model_with_tools = model.bind(functions=tools)
@@ -26,7 +31,7 @@ def should_continue(state):
     messages = state["messages"]
     last_message = messages[-1]
     # If there is no function call, then we finish
-    if "function_call" not in last_message.additional_kwargs:
+    if not get_function_calls(last_message):
         return "end"
     # Otherwise if there is, we continue
     else:
@@ -41,23 +46,48 @@ def call_model(state):
     return {"messages": [response]}
 
 
+def get_function_calls(message: BaseMessage) -> list[dict]:
+    """Function calls of the message, with the id of the tool call if there is one.
+    Gemini returns a single `function_call`, OpenAI models may return several `tool_calls`.
+    """
+    if "tool_calls" in message.additional_kwargs:
+        return [
+            {"id": tool_call["id"], **tool_call["function"]}
+            for tool_call in message.additional_kwargs["tool_calls"]
+        ]
+    if "function_call" in message.additional_kwargs:
+        return [message.additional_kwargs["function_call"]]
+    return []
+
+
 def call_tool(state):
-    """Function to execute tools."""
+    """Function to execute tools. The function calls of the last message run concurrently."""
     messages = state["messages"]
     # Based on the continue condition
     # we know the last message involves a function call
     last_message = messages[-1]
-    # We construct an ToolInvocation from the function_call
-    action = ToolInvocation(
-        tool=last_message.additional_kwargs["function_call"]["name"],
-        tool_input=json.loads(last_message.additional_kwargs["function_call"]["arguments"]),
-    )
-    # We call the tool_executor and get back a response
-    response = tool_executor.invoke(action)
-    # We use the response to create a FunctionMessage
-    function_message = FunctionMessage(content=str(response), name=action.tool)
+    function_calls = get_function_calls(last_message)
+    # We start a ToolInvocation for each function call
+    tool_calls = [
+        ToolCall(
+            tool_executor.invoke,
+            ToolInvocation(tool=call["name"], tool_input=json.loads(call["arguments"])),
+        )
+        for call in function_calls
+    ]
+    # We use the responses to create FunctionMessages, or ToolMessages for tool calls
+    result = []
+    for call, tool_call in zip(function_calls, tool_calls):
+        try:
+            response = tool_call.result(TOOL_TIMEOUT)
+        except TimeoutError:
+            response = f"{call['name']} did not respond within {TOOL_TIMEOUT} seconds"
+        if "id" in call:
+            result.append(ToolMessage(content=str(response), tool_call_id=call["id"]))
+        else:
+            result.append(FunctionMessage(content=str(response), name=call["name"]))
     # We return a list, because this will get added to the existing list
-    return {"messages": [function_message]}
+    return {"messages": result}
 
 
 def build_graph():
@@ -0,0 +1,72 @@
+"""
+Liveness and readiness probes for the model servers.
+
+`/healthz` answers as soon as the process serves HTTP. `/readyz` returns 503 until the
+model weights are loaded and a warmup generation has run, so orchestrators and load
+balancers only send traffic to warm replicas.
+"""
+
+import os
+import time
+from typing import Awaitable, Callable
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from loguru import logger
+
+PREFETCH_CHUNK_SIZE = 16 * 2**20
+
+
+def prefetch(path: str) -> None:
+    """Reads a model file into the page cache, so that mmap-loading it does not fault
+    every page in from disk on the first requests."""
+    if not os.path.exists(path):
+        return
+    logger.info(f"Prefetching {path} ...")
+    start = time.perf_counter()
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(PREFETCH_CHUNK_SIZE)
+        while f.readinto(buffer):
+            pass
+    logger.info(f"Prefetched {path} in {time.perf_counter() - start:.1f}s")
+
+
+class Readiness:
+    """Tracks whether the server is ready to take traffic."""
+
+    def __init__(self) -> None:
+        self.status = "starting"
+        self.error = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    async def warm_up(self, load: Callable[[], Awaitable]) -> None:
+        """Awaits `load`, which loads the model and runs a warmup generation."""
+        self.status = "loading"
+        start = time.perf_counter()
+        try:
+            await load()
+        except Exception as e:
+            logger.exception("Warmup failed")
+            self.status = "failed"
+            self.error = str(e)
+            return
+        self.status = "ready"
+        logger.info(f"Ready in {time.perf_counter() - start:.1f}s")
+
+
+def add_health_routes(app: FastAPI, readiness: Readiness) -> None:
+    @app.get("/healthz")
+    def healthz() -> dict:
+        return {"status": "ok"}
+
+    @app.get("/readyz")
+    def readyz() -> JSONResponse:
+        content = {"status": readiness.status}
+        if readiness.error is not None:
+            content["error"] = readiness.error
+        return JSONResponse(content, status_code=200 if readiness.ready else 503)
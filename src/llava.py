@@ -1,4 +1,7 @@
+import ctypes
+import hashlib
 import os
+from collections import OrderedDict
 
 from loguru import logger
 from llama_cpp import Llama
@@ -7,6 +10,56 @@ from llama_cpp.llama_chat_format import Llava15ChatHandler
 from src import CFG
 
 
+class ImageEmbedCache:
+    """Wraps the llava_cpp bindings used by `Llava15ChatHandler` to reuse the CLIP
+    embeddings of images seen before, keyed by a hash of the image bytes.
+
+    The handler re-runs the vision encoder on every call, while the chat UI resends the
+    same image with every follow-up question. Cached embeddings are not freed by the
+    handler; the least recently used ones are freed beyond `max_bytes`.
+    """
+
+    def __init__(self, llava_cpp, n_embd: int, max_bytes: int) -> None:
+        self._llava_cpp = llava_cpp
+        self.n_embd = n_embd
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._embeds: OrderedDict[str, tuple] = OrderedDict()
+        self._cached: set[int] = set()
+
+    def __getattr__(self, name):
+        return getattr(self._llava_cpp, name)
+
+    def llava_image_embed_make_with_bytes(self, ctx_clip, n_threads, image_bytes, length):
+        key = hashlib.sha256(ctypes.string_at(image_bytes, length)).hexdigest()
+        if key in self._embeds:
+            self._embeds.move_to_end(key)
+            logger.debug(f"Image embedding cache hit {key[:12]}")
+            return self._embeds[key][0]
+
+        embed = self._llava_cpp.llava_image_embed_make_with_bytes(
+            ctx_clip, n_threads, image_bytes, length
+        )
+        nbytes = embed.contents.n_image_pos * self.n_embd * ctypes.sizeof(ctypes.c_float)
+        if nbytes > self.max_bytes:
+            return embed
+
+        self._embeds[key] = (embed, nbytes)
+        self._cached.add(ctypes.addressof(embed.contents))
+        self.nbytes += nbytes
+        # the new embedding is about to be evaluated, so it is never evicted here
+        while self.nbytes > self.max_bytes:
+            _, (old, old_nbytes) = self._embeds.popitem(last=False)
+            self._cached.discard(ctypes.addressof(old.contents))
+            self._llava_cpp.llava_image_embed_free(old)
+            self.nbytes -= old_nbytes
+        return embed
+
+    def llava_image_embed_free(self, embed) -> None:
+        if ctypes.addressof(embed.contents) not in self._cached:
+            self._llava_cpp.llava_image_embed_free(embed)
+
+
 def load_llava() -> Llama:
     """Load llava model."""
     logger.info("Loading llava model ...")
@@ -19,6 +72,10 @@ def load_llava() -> Llama:
         n_ctx=2048,  # n_ctx should be increased to accomodate the image embedding
         logits_all=True,
     )
+    handler = model.chat_handler
+    handler._llava_cpp = ImageEmbedCache(
+        handler._llava_cpp, model.n_embd(), max_bytes=CFG.LLAVA_IMAGE_CACHE_MB * 2**20
+    )
     logger.info("Model loaded")
     return model
 
@@ -1,11 +1,200 @@
+import json
 import os
-from typing import Optional
+import threading
+import time
+import types
+from typing import Any, Callable, Optional
 
 from langchain_core.callbacks import StreamingStdOutCallbackHandler
 from langchain_community.llms.ctransformers import CTransformers
 from langchain_community.llms.llamacpp import LlamaCpp
+from loguru import logger
 
 from src import CFG
+from src.autotune import load_profile
+
+
+class RegisteredModel:
+    def __init__(self, key: tuple, model_path: str, llm) -> None:
+        self.key = key
+        self.model_path = model_path
+        self.llm = llm
+        # ctransformers and llama.cpp models cannot run two generations at once
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    @property
+    def file_bytes(self) -> int:
+        return os.path.getsize(self.model_path) if os.path.exists(self.model_path) else 0
+
+
+class LockedClient:
+    """Serializes calls to a model client, holding the lock while a streamed output is
+    iterated. Other attributes are those of the client.
+
+    The client can be unloaded to free its weights, and is loaded again on next use, so
+    that callers holding the LLM keep working without a second copy being loaded.
+    """
+
+    def __init__(self, client, model: RegisteredModel, load_client: Callable[[], Any]) -> None:
+        self._client = client
+        self._model = model
+        self._load_client = load_client
+        self._load_lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._client is not None
+
+    def __getattr__(self, name):
+        # own attributes are missing while the object is copied or unpickled
+        if name in ("_client", "_model", "_load_client", "_load_lock"):
+            raise AttributeError(name)
+        return getattr(self._get_client(), name)
+
+    def __call__(self, *args, **kwargs):
+        self._model.lock.acquire()
+        try:
+            output = self._get_client()(*args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        if isinstance(output, types.GeneratorType):
+            return self._iterate(output)
+        self._release()
+        return output
+
+    def unload(self) -> bool:
+        """Drops the client unless it is in use. Returns whether it was unloaded."""
+        if not self._model.lock.acquire(blocking=False):
+            return False
+        try:
+            with self._load_lock:
+                unloaded, self._client = self._client is not None, None
+        finally:
+            self._model.lock.release()
+        return unloaded
+
+    def _get_client(self):
+        with self._load_lock:
+            if self._client is None:
+                logger.info(f"Reloading {self._model.model_path} ...")
+                self._client = self._load_client()
+            return self._client
+
+    def _iterate(self, output):
+        try:
+            yield from output
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self._model.last_used = time.monotonic()
+        self._model.lock.release()
+
+
+class ModelRegistry:
+    """Shares model instances within the process, keyed by model path and config.
+
+    Args:
+        idle_ttl: Seconds after which the weights of a model that has not been used are
+            freed. The model stays registered and is loaded again on next use. 0 keeps
+            models loaded.
+    """
+
+    def __init__(self, idle_ttl: float = 0) -> None:
+        self.idle_ttl = idle_ttl
+        self.models: dict[tuple, RegisteredModel] = {}
+        # guards self.models only; loading a model takes the lock of its key, so that
+        # lookups of other models do not wait for it
+        self._lock = threading.Lock()
+        self._load_locks: dict[tuple, threading.Lock] = {}
+        self._reaper = None
+
+    def get(self, key: tuple, model_path: str, load: Callable[[], Any]):
+        """Returns the registered model, loading it first if needed."""
+        with self._lock:
+            model = self.models.get(key)
+            if model is None:
+                load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        if model is None:
+            with load_lock:
+                # another caller may have loaded it meanwhile
+                with self._lock:
+                    model = self.models.get(key)
+                if model is None:
+                    logger.info(f"Loading {model_path} ...")
+                    model = RegisteredModel(key, model_path, load())
+                    model.llm.client = LockedClient(
+                        model.llm.client, model, lambda: load().client
+                    )
+                    with self._lock:
+                        self.models[key] = model
+                        del self._load_locks[key]
+                        self._start_reaper()
+        model.last_used = time.monotonic()
+        return model.llm
+
+    def unload(self, key: tuple) -> None:
+        """Frees the weights of the model, which callers may still hold."""
+        model = self.models.get(key)
+        if model is not None and model.llm.client.unload():
+            logger.info(f"Unloaded {model.model_path}")
+
+    def unload_idle(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            models = list(self.models.values())
+        for model in models:
+            if model.llm.client.loaded and now - model.last_used > self.idle_ttl:
+                self.unload(model.key)
+
+    def memory_report(self) -> dict:
+        """Resident memory of the process and the registered models."""
+        with self._lock:
+            models = list(self.models.values())
+        return {
+            "rss_bytes": get_rss_bytes(),
+            "models": [
+                {
+                    "model_path": m.model_path,
+                    "file_bytes": m.file_bytes,
+                    "loaded": m.llm.client.loaded,
+                    "in_use": m.lock.locked(),
+                    "idle_seconds": time.monotonic() - m.last_used,
+                }
+                for m in models
+            ],
+        }
+
+    def _start_reaper(self) -> None:
+        if self.idle_ttl <= 0 or self._reaper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(min(self.idle_ttl, 60))
+                self.unload_idle()
+
+        self._reaper = threading.Thread(target=run, name="model-reaper", daemon=True)
+        self._reaper.start()
+
+
+def get_rss_bytes() -> Optional[int]:
+    """Resident set size of the process, including mmap-ed weights that are paged in."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def make_key(*parts) -> tuple:
+    return tuple(json.dumps(p, sort_keys=True, default=str) for p in parts)
+
+
+REGISTRY = ModelRegistry(idle_ttl=CFG.MODEL_REGISTRY.IDLE_TTL)
 
 
 def build_llm():
@@ -34,7 +223,7 @@ def build_llm():
 def build_ctransformers(
     model_path: str, config: Optional[dict] = None, debug: bool = False, **kwargs
 ):
-    """Builds LLM using CTransformers."""
+    """Builds LLM using CTransformers, shared with other callers of the same config."""
     if config is None:
         config = {
             "max_new_tokens": 512,
@@ -42,18 +231,23 @@ def build_ctransformers(
             "repetition_penalty": 1.1,
             "context_length": 1024,
         }
+    # threads, batch size and mmap/mlock tuned for this machine by src.autotune
+    config = {**load_profile(model_path, "ctransformers"), **config}
 
-    llm = CTransformers(
-        model=model_path,
-        config=config,
-        callbacks=[StreamingStdOutCallbackHandler()] if debug else None,
-        **kwargs,
+    return REGISTRY.get(
+        make_key("ctransformers", model_path, config, debug, kwargs),
+        model_path,
+        lambda: CTransformers(
+            model=model_path,
+            config=config,
+            callbacks=[StreamingStdOutCallbackHandler()] if debug else None,
+            **kwargs,
+        ),
     )
-    return llm
 
 
 def build_llamacpp(model_path: str, config: Optional[dict] = None, debug: bool = False, **kwargs):
-    """Builds LLM using LlamaCpp."""
+    """Builds LLM using LlamaCpp, shared with other callers of the same config."""
     if config is None:
         config = {
             "max_tokens": 512,
@@ -61,11 +255,15 @@ def build_llamacpp(model_path: str, config: Optional[dict] = None, debug: bool =
             "repeat_penalty": 1.1,
             "n_ctx": 1024,
         }
+    config = {**load_profile(model_path, "llamacpp"), **config}
 
-    llm = LlamaCpp(
-        model_path=model_path,
-        **config,
-        callbacks=[StreamingStdOutCallbackHandler()] if debug else None,
-        **kwargs,
+    return REGISTRY.get(
+        make_key("llamacpp", model_path, config, debug, kwargs),
+        model_path,
+        lambda: LlamaCpp(
+            model_path=model_path,
+            **config,
+            callbacks=[StreamingStdOutCallbackHandler()] if debug else None,
+            **kwargs,
+        ),
     )
-    return llm
@@ -0,0 +1,176 @@
+"""
+Minimal metrics in the Prometheus text exposition format.
+"""
+
+import bisect
+import threading
+from typing import Callable, Optional
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = (0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{k}="{v}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _snapshot(self) -> dict:
+        """Copy of the values, as other threads may add label values during a scrape."""
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(labels[k] for k in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, k)} {v}"
+            for k, v in self._snapshot().items()
+        ]
+
+
+class Gauge(Metric):
+    """Gauge whose values are either set directly or collected by a callback at scrape
+    time. The callback returns a dict of label values tuple to value."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        collect: Optional[Callable[[], dict]] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(labels[k] for k in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> list[str]:
+        values = self.collect() if self.collect is not None else self._snapshot()
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[k] for k in self.labelnames)
+        with self._lock:
+            # per-bucket counts, sum and count
+            counts, total, n = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                counts[i] += 1
+            self._values[key] = (counts, total + value, n + 1)
+
+    def _snapshot(self) -> dict:
+        # the bucket counts are updated in place
+        with self._lock:
+            return {
+                key: (list(counts), total, n) for key, (counts, total, n) in self._values.items()
+            }
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, n) in self._snapshot().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {n}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    """Renders all registered metrics."""
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+# Generation metrics, labelled by model name
+REQUESTS = Counter(
+    "llm_requests_total", "Finished generation requests.", ("model", "finish_reason")
+)
+PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "Prompt tokens processed.", ("model",))
+CACHED_PROMPT_TOKENS = Counter(
+    "llm_cached_prompt_tokens_total", "Prompt tokens reused from the KV cache.", ("model",)
+)
+COMPLETION_TOKENS = Counter("llm_completion_tokens_total", "Tokens generated.", ("model",))
+# acceptance rate of speculative decoding is accepted / drafted
+DRAFT_TOKENS = Counter(
+    "llm_draft_tokens_total", "Tokens proposed by the draft model.", ("model",)
+)
+ACCEPTED_DRAFT_TOKENS = Counter(
+    "llm_draft_accepted_tokens_total", "Drafted tokens accepted by the target model.", ("model",)
+)
+QUEUE_TIME = Histogram(
+    "llm_queue_time_seconds", "Time from arrival until a slot is assigned.", ("model",)
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds", "Time from arrival to the first token.", ("model",)
+)
+INTER_TOKEN_LATENCY = Histogram(
+    "llm_inter_token_latency_seconds", "Time between consecutive tokens.", ("model",)
+)
+TOKENS_PER_SECOND = Histogram(
+    "llm_decode_tokens_per_second",
+    "Decode throughput of each request after its first token.",
+    ("model",),
+    buckets=THROUGHPUT_BUCKETS,
+)
+EMBEDDED_TEXTS = Counter(
+    "embedding_texts_total", "Texts embedded, by whether the vector was cached.", ("cached",)
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "embedding_batch_size", "Texts encoded per forward pass.", buckets=BATCH_SIZE_BUCKETS
+)
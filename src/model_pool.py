@@ -0,0 +1,119 @@
+"""
+Hosts several local models in one process.
+
+Models are loaded on first use and the least recently used idle model is unloaded when
+the estimated resident memory exceeds the budget.
+"""
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+from loguru import logger
+
+from src.engine import Engine
+from src.prompt_format import PromptFormat
+
+
+@dataclass
+class ModelSpec:
+    name: str
+    model_path: str
+    prompt_format: PromptFormat
+    # KV cache memory of all contexts of the engine, on top of the weights
+    kv_cache_bytes: int = 0
+    # small model sharing the vocabulary, for speculative decoding
+    draft_model_path: Optional[str] = None
+
+    @property
+    def memory_bytes(self) -> int:
+        paths = [self.model_path, self.draft_model_path]
+        # weights are not loaded from disk by the fake backend
+        weights = sum(os.path.getsize(p) for p in paths if p and os.path.exists(p))
+        return weights + self.kv_cache_bytes
+
+
+class ServedModel:
+    def __init__(self, spec: ModelSpec, engine: Engine) -> None:
+        self.spec = spec
+        self.engine = engine
+        self.users = 0
+        self.last_used = time.perf_counter()
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    @property
+    def prompt_format(self) -> PromptFormat:
+        return self.spec.prompt_format
+
+
+class ModelPool:
+    """Lazily loads models by name and evicts idle ones in LRU order.
+
+    Args:
+        specs: Models that can be served, keyed by name.
+        loader: Callable that builds the engine of a model spec.
+        memory_budget: Maximum estimated bytes of resident models.
+    """
+
+    def __init__(
+        self,
+        specs: dict[str, ModelSpec],
+        loader: Callable[[ModelSpec], Engine],
+        memory_budget: int,
+    ) -> None:
+        self.specs = specs
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.models: dict[str, ServedModel] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def memory_used(self) -> int:
+        return sum(m.spec.memory_bytes for m in self.models.values())
+
+    @asynccontextmanager
+    async def acquire(self, name: str) -> AsyncIterator[ServedModel]:
+        """Yields the loaded model, loading it first if needed."""
+        if name not in self.specs:
+            raise KeyError(name)
+
+        model = self.models.get(name)
+        if model is None:
+            async with self._lock:
+                model = self.models.get(name)
+                if model is None:
+                    spec = self.specs[name]
+                    await self._make_room(spec.memory_bytes)
+                    logger.info(f"Loading model {name} ...")
+                    engine = await asyncio.to_thread(self.loader, spec)
+                    model = self.models[name] = ServedModel(spec, engine)
+        model.users += 1
+
+        try:
+            yield model
+        finally:
+            model.users -= 1
+            model.last_used = time.perf_counter()
+
+    async def _make_room(self, required: int) -> None:
+        while self.models and self.memory_used + required > self.memory_budget:
+            victim = self._least_recently_used()
+            if victim is None:
+                logger.warning("Memory budget exceeded but all loaded models are in use")
+                return
+            await self.unload(victim.name)
+
+    def _least_recently_used(self) -> Optional[ServedModel]:
+        idle = [m for m in self.models.values() if m.users == 0]
+        return min(idle, key=lambda m: m.last_used, default=None)
+
+    async def unload(self, name: str) -> None:
+        model = self.models.pop(name)
+        logger.info(f"Unloading model {name}")
+        await asyncio.to_thread(model.engine.shutdown)
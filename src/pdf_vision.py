@@ -0,0 +1,191 @@
+"""
+Batch extraction of PDF pages with the LLaVA server.
+
+Pages are rendered in parallel worker processes at the given DPI, and pages without
+tables, images or charts are skipped. Rendered pages are sent to serve_llava.py with
+bounded concurrency in the batch lane, so that interactive requests go first, and each
+result is appended to a JSONL file as soon as it arrives.
+Pages already in the output file are not processed again, so an interrupted run resumes
+where it stopped.
+
+    python -m src.pdf_vision report.pdf --output report.jsonl --dpi 100 --workers 8
+"""
+
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import fitz
+import requests
+from loguru import logger
+
+from src import CFG
+
+DEFAULT_PROMPT = (
+    "Extract the tables and figures on this page. Output your response as json, with the "
+    "title of each table or figure as key and its data as value."
+)
+# vector charts are drawn with many paths; text-only pages have few
+MIN_DRAWINGS = 20
+# attempts of a page that the server rejects as overloaded, with 429 or 503
+MAX_ATTEMPTS = 5
+
+_document: Optional[fitz.Document] = None
+_dpi = 100
+
+
+def _init_worker(pdf_filepath: str, dpi: int) -> None:
+    global _document, _dpi
+    _document = fitz.open(pdf_filepath)
+    _dpi = dpi
+
+
+def has_visuals(page: fitz.Page) -> bool:
+    """Whether the page has images, vector charts or tables."""
+    if page.get_images() or len(page.get_drawings()) >= MIN_DRAWINGS:
+        return True
+    return bool(page.find_tables().tables)
+
+
+def render_page(page_number: int) -> tuple[int, Optional[str]]:
+    """Renders a page of the worker's document as a PNG data URL, or None if skipped."""
+    page = _document[page_number]
+    if not has_visuals(page):
+        return page_number, None
+    png = page.get_pixmap(dpi=_dpi).tobytes("png")
+    return page_number, "data:image/png;base64," + base64.b64encode(png).decode("utf-8")
+
+
+def get_page_response(api_url: str, image_url: str, prompt: str, timeout: float) -> str:
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": image_url}},
+                {"type": "text", "text": prompt},
+            ],
+        }
+    ]
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        response = requests.post(
+            api_url, json={"inputs": messages}, headers={"X-Priority": "batch"}, timeout=timeout
+        )
+        if response.status_code not in (429, 503) or attempt == MAX_ATTEMPTS:
+            break
+        retry_after = float(response.headers.get("Retry-After", 10))
+        logger.info(f"Server busy ({response.status_code}), retrying in {retry_after:.0f}s")
+        time.sleep(retry_after)
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def load_done_pages(output: str) -> set[int]:
+    """Pages with a result in the output file, excluding failed ones."""
+    if not os.path.exists(output):
+        return set()
+    with open(output) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {r["page"] for r in records if "error" not in r}
+
+
+def extract_pages(
+    pdf_filepath: str,
+    output: str,
+    prompt: str = DEFAULT_PROMPT,
+    dpi: int = 100,
+    workers: int = 4,
+    concurrency: int = CFG.ADMISSION.LLAVA.MAX_CONCURRENCY,
+    api_url: str = f"http://{CFG.HOST}:{CFG.PORT.LLAVA}",
+    timeout: float = 600,
+) -> None:
+    """Renders the pages with `workers` processes and sends at most `concurrency` pages
+    to the server at a time, appending one JSON record per page to `output`. Keep
+    `concurrency` at or below the server's ADMISSION.LLAVA.MAX_CONCURRENCY, as extra pages
+    only wait in the server queue."""
+    done = load_done_pages(output)
+    with fitz.open(pdf_filepath) as doc:
+        pages = iter([i for i in range(doc.page_count) if i not in done])
+    logger.info(f"{len(done)} page(s) already done")
+
+    lock = threading.Lock()
+    # rendered pages waiting for the server, to bound memory
+    ready = threading.BoundedSemaphore(2 * concurrency)
+
+    with open(output, "a") as f:
+
+        def write(record: dict) -> None:
+            with lock:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+
+        def send(page_number: int, image_url: str) -> None:
+            start = time.perf_counter()
+            try:
+                content = get_page_response(api_url, image_url, prompt, timeout)
+                record = {"page": page_number, "response": content}
+                logger.info(f"Page {page_number} done in {time.perf_counter() - start:.1f}s")
+            except Exception as e:
+                logger.error(f"Page {page_number} failed: {e}")
+                record = {"page": page_number, "error": str(e)}
+            finally:
+                ready.release()
+            write(record)
+
+        def dispatch(rendered: tuple[int, Optional[str]]) -> None:
+            page_number, image_url = rendered
+            if image_url is None:
+                write({"page": page_number, "skipped": True})
+                return
+            ready.acquire()
+            senders.submit(send, page_number, image_url)
+
+        with ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(pdf_filepath, dpi)
+        ) as renderers, ThreadPoolExecutor(concurrency) as senders:
+            # keep the render processes busy without rendering the whole document ahead
+            rendering = deque()
+            for page_number in pages:
+                rendering.append(renderers.submit(render_page, page_number))
+                if len(rendering) >= 2 * workers:
+                    dispatch(rendering.popleft().result())
+            while rendering:
+                dispatch(rendering.popleft().result())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("pdf_filepath", type=str)
+    parser.add_argument("--output", type=str, required=True, help="JSONL file of results")
+    parser.add_argument("--prompt", type=str, default=DEFAULT_PROMPT)
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Render processes")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=CFG.ADMISSION.LLAVA.MAX_CONCURRENCY,
+        help="Requests to the server, at most its ADMISSION.LLAVA.MAX_CONCURRENCY",
+    )
+    parser.add_argument("--api-url", type=str, default=f"http://{CFG.HOST}:{CFG.PORT.LLAVA}")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    extract_pages(
+        args.pdf_filepath,
+        args.output,
+        prompt=args.prompt,
+        dpi=args.dpi,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        api_url=args.api_url,
+    )
+    logger.info(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,17 @@
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+class PromptTooLongError(ValueError):
+    def __init__(self, n_tokens: int, max_tokens: int) -> None:
+        super().__init__(
+            f"The latest message needs {n_tokens} prompt tokens, "
+            f"more than the {max_tokens} available"
+        )
+        self.n_tokens = n_tokens
+        self.max_tokens = max_tokens
+
+
 class PromptFormat:
     B_INST = ""
     E_INST = ""
@@ -9,9 +23,24 @@ class PromptFormat:
         "You are a helpful, respectful and honest assistant. "
         "Always answer as helpfully as possible, while being safe."
     )
+    # number of cached token counts of prompt segments
+    TOKEN_CACHE_SIZE = 4096
+
+    def __init__(self) -> None:
+        self._token_counts: OrderedDict[str, int] = OrderedDict()
+
+    def get_prompt(
+        self,
+        messages: list[dict[str, str]],
+        max_tokens: Optional[int] = None,
+        tokenize: Optional[Callable[[str], list[int]]] = None,
+    ) -> str:
+        """Converts messages to compliant prompt format.
 
-    def get_prompt(self, messages: list[dict[str, str]]) -> str:
-        """Converts messages to compliant prompt format."""
+        If `max_tokens` and `tokenize` are given, the oldest turns of chat history are
+        dropped so that the prompt fits in `max_tokens`. The system prompt and the latest
+        message are always kept, and PromptTooLongError is raised if they alone do not fit.
+        """
         # if messages are in langchain.schema, convert to dict
         if messages[0]["role"] != "system":
             system_prompt = self.SYSTEM_PROMPT
@@ -25,8 +54,44 @@ class PromptFormat:
         ]
 
         user_prompt = messages[-1]["content"]
+        if max_tokens is not None and tokenize is not None:
+            chat_history = self._truncate(
+                user_prompt, chat_history, system_prompt, max_tokens, tokenize
+            )
         return self._format(user_prompt, chat_history, system_prompt)
 
+    def _truncate(
+        self,
+        message: str,
+        chat_history: list[tuple[str, str]],
+        system_prompt: str,
+        max_tokens: int,
+        tokenize: Callable[[str], list[int]],
+    ) -> list[tuple[str, str]]:
+        """Keeps the newest turns of chat history that fit in the token budget."""
+        used = self._count_tokens(self._format(message, [], system_prompt), tokenize)
+        if used > max_tokens:
+            raise PromptTooLongError(used, max_tokens)
+        kept = 0
+        for user_input, response in reversed(chat_history):
+            n = self._count_tokens(self._format_turn(user_input.strip(), response), tokenize)
+            if used + n > max_tokens:
+                break
+            used += n
+            kept += 1
+        return chat_history[len(chat_history) - kept:]
+
+    def _count_tokens(self, text: str, tokenize: Callable[[str], list[int]]) -> int:
+        """Counts tokens of a prompt segment, cached as the same turns recur every turn."""
+        if text in self._token_counts:
+            self._token_counts.move_to_end(text)
+            return self._token_counts[text]
+
+        n = self._token_counts[text] = len(tokenize(text))
+        if len(self._token_counts) > self.TOKEN_CACHE_SIZE:
+            self._token_counts.popitem(last=False)
+        return n
+
     def _format(
         self, message: str, chat_history: list[tuple[str, str]], system_prompt: str
     ) -> str:
@@ -38,13 +103,14 @@ class PromptFormat:
         for user_input, response in chat_history:
             user_input = user_input.strip() if do_strip else user_input
             do_strip = True
-            texts.append(
-                f"{user_input} {self.E_INST} {response.strip()} {self.EOS}{self.BOS}{self.B_INST} "
-            )
+            texts.append(self._format_turn(user_input, response))
         message = message.strip() if do_strip else message
         texts.append(f"{message} {self.E_INST}")
         return "".join(texts)
 
+    def _format_turn(self, user_input: str, response: str) -> str:
+        return f"{user_input} {self.E_INST} {response.strip()} {self.EOS}{self.BOS}{self.B_INST} "
+
 
 class Llama2Format(PromptFormat):
     B_INST = "[INST]"
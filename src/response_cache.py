@@ -0,0 +1,142 @@
+"""
+Exact-match cache of completions for deterministic requests.
+
+Entries expire after `ttl` seconds and the least recently used ones are evicted beyond
+`max_entries`. With `path`, entries are also kept in a SQLite file so that they survive
+restarts. The SQLite connection is opened on first use, so that each worker process of
+`serve.py --workers` opens its own rather than inheriting one across fork. Concurrent
+requests for the same key wait for a single generation.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from loguru import logger
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.path = path
+        self._conn = None
+        self._conn_pid = None
+
+    @property
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """Connection of the current process, opened on first use."""
+        if self.path is None:
+            return None
+        if self._conn_pid != os.getpid():
+            # a connection must not be used across fork, so never reuse the parent's
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)"
+            )
+            conn.commit()
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Hashes the JSON-serializable parts that determine a response."""
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > now:
+                self._memory.move_to_end(key)
+                return value
+            del self._memory[key]
+
+        if self.path is not None:
+            try:
+                db = self._db
+                row = db.execute(
+                    "SELECT value, expires FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    db.commit()
+                    value = json.loads(row[0])
+                    self._put_memory(key, row[1], value)
+                    return value
+            except sqlite3.Error as e:
+                # e.g. the database is locked by another worker
+                logger.warning(f"Unable to read cached response: {e}")
+        return None
+
+    def set(self, key: str, value: dict) -> None:
+        expires = time.time() + self.ttl
+        self._put_memory(key, expires, value)
+        if self.path is not None:
+            db = self._db
+            db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, time.time()),
+            )
+            # drop expired entries and keep the most recently used ones
+            db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+            db.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            db.commit()
+
+    def _put_memory(self, key: str, expires: float, value: dict) -> None:
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[dict]],
+        cacheable: Callable[[dict], bool] = lambda value: True,
+    ) -> dict:
+        """Returns the cached value, or computes it once for all concurrent callers."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        if key in self._inflight:
+            value = await asyncio.shield(self._inflight[key])
+            if value is not None:
+                return value
+            # the leader's result was not cacheable, e.g. it was cancelled
+            return await compute()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            del self._inflight[key]
+
+        if cacheable(value):
+            try:
+                self.set(key, value)
+            except sqlite3.Error as e:
+                logger.warning(f"Unable to persist cached response: {e}")
+            future.set_result(value)
+        else:
+            future.set_result(None)
+        return value
@@ -11,6 +11,9 @@ from langchain.agents import tool
 
 # from openbb import obb
 
+# seconds, so that a stalled download does not keep an agent step waiting
+DOWNLOAD_TIMEOUT = 20
+
 
 class Stock:
     def __init__(self, symbol: str):
@@ -19,7 +22,7 @@ class Stock:
     @cache
     def get_prices(self) -> pd.DataFrame:
         start_date = (datetime.now() - timedelta(days=365 * 2)).strftime("%Y-%m-%d")
-        df = yf.download(self.symbol, start=start_date)
+        df = yf.download(self.symbol, start=start_date, timeout=DOWNLOAD_TIMEOUT)
         df.columns = ["open", "high", "low", "close", "adjclose", "volume"]
         # df = obb.equity.price.historical(
         #     self.symbol, start_date=start_date, provider="yfinance"
@@ -0,0 +1,83 @@
+"""
+Runs several worker processes of a model server on one port.
+
+The parent binds the listening socket and forks the workers, which accept connections
+from it, so the kernel spreads requests across them. Each worker is pinned to its own
+share of the CPU cores. Weights are memory-mapped read-only from the same GGUF file,
+so all workers share one copy in the page cache instead of loading N copies.
+
+Admission, the response cache and metrics stay per worker.
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+
+import uvicorn
+from loguru import logger
+
+
+def available_cores() -> list[int]:
+    """CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(num_workers: int) -> list[list[int]]:
+    """Splits the available cores into contiguous groups, one per worker."""
+    cores = available_cores()
+    if num_workers > len(cores):
+        logger.warning(f"{num_workers} workers share {len(cores)} cores")
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    groups, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (i < extra)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _run_worker(config: uvicorn.Config, sock, cores: list[int]) -> None:
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    logger.info(f"Worker {os.getpid()} on cores {cores[0]}-{cores[-1]}")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def run_workers(app, host: str, port: int, num_workers: int) -> None:
+    """Serves the app from `num_workers` processes, restarting workers that die."""
+    config = uvicorn.Config(app, host=host, port=port)
+    sock = config.bind_socket()
+    # fork so that workers inherit the app configured by the command line
+    context = multiprocessing.get_context("fork")
+    groups = split_cores(num_workers)
+
+    def start(cores):
+        process = context.Process(target=_run_worker, args=(config, sock, cores), daemon=True)
+        process.start()
+        return process
+
+    workers = [start(cores) for cores in groups]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while not stopping:
+        for i, process in enumerate(workers):
+            if not process.is_alive():
+                logger.warning(f"Worker {process.pid} exited with {process.exitcode}, restarting")
+                workers[i] = start(groups[i])
+        time.sleep(1)
+
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join()
+    sock.close()
@@ -5,12 +5,16 @@ from requests.exceptions import ConnectionError, Timeout, HTTPError
 
 def get_http_status(url):
     try:
-        r = requests.get(url + "/docs")
+        r = requests.get(url + "/healthz", timeout=5)
         r.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xx
+        r = requests.get(url + "/readyz", timeout=5)
 
     except (ConnectionError, Timeout) as e:
         st.sidebar.error(f"ConnectionError: Model is not deployed - {e}")
     except HTTPError as e:
         st.sidebar.error(e)
     else:
-        st.sidebar.info("Endpoint is OK")
+        if r.ok:
+            st.sidebar.info("Endpoint is OK")
+        else:
+            st.sidebar.warning(f"Model is not ready: {r.json().get('status')}")
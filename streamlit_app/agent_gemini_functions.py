@@ -6,12 +6,11 @@ https://github.com/langchain-ai/langchain/blob/master/templates/gemini-functions
 from typing import List, Tuple
 
 import streamlit as st
-from langchain.agents import AgentExecutor
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-from src.agents import create_gemini_functions_agent
+from src.agents import ParallelAgentExecutor, create_gemini_functions_agent
 from src.tools import (
     tavily_tool,
     wikipedia_tool,
@@ -50,8 +49,8 @@ class AgentInput(BaseModel):
     )
 
 
-agent_executor = AgentExecutor(
-    agent=agent, tools=tools, max_execution_time=60, verbose=True
+agent_executor = ParallelAgentExecutor(
+    agent=agent, tools=tools, max_execution_time=60, tool_timeout=30, verbose=True
 ).with_types(input_type=AgentInput)
 
 
@@ -1,11 +1,12 @@
+from typing import Any
+
 import streamlit as st
 from langchain_community.callbacks.streamlit import StreamlitCallbackHandler
 from langchain_core.prompts import PromptTemplate
-from langchain.agents import AgentExecutor
 from langchain_google_genai import GoogleGenerativeAI
 
 from src.chains import condense_question_chain
-from src.agents import create_react_agent
+from src.agents import ParallelAgentExecutor, create_react_agent
 from src.tools import (
     tavily_tool,
     wikipedia_tool,
@@ -45,7 +46,8 @@ Question: the input question you must answer
 Thought: you should always think about what to do
 Action: the action to take, should be one of [{tool_names}]
 Action Input: the input to the action
-Observation: the result of the action
+... (this Action/Action Input can repeat for actions that do not depend on each other)
+Observation: the results of the actions
 ... (this Thought/Action/Action Input/Observation can repeat N times)
 Thought: I now know the final answer
 Final Answer: the final answer to the original input question
@@ -62,19 +64,42 @@ agent = create_react_agent(
     tools=tools,
     prompt=prompt,
     stop_sequence=True,
+    start_tools=True,
 )
-agent_executor = AgentExecutor(
+agent_executor = ParallelAgentExecutor(
     agent=agent,
     tools=tools,
     return_intermediate_steps=True,
     handle_parsing_errors=True,
     max_execution_time=60,
+    tool_timeout=30,
     verbose=True,
 )
 
 _chain = condense_question_chain(llm)
 
 
+class AgentCallbackHandler(StreamlitCallbackHandler):
+    """Writes the final answer as it is streamed. Generations cancelled by the output
+    parser are shown as finished rather than failed."""
+
+    def __init__(self, answer_container, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._answer_container = answer_container
+        self._answer = ""
+
+    def on_text(self, text: str, final_answer: bool = False, **kwargs: Any) -> None:
+        if final_answer:
+            self._answer += text
+            self._answer_container.markdown(self._answer.replace("$", r"\$"))
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        if isinstance(error, GeneratorExit):
+            self.on_llm_end(kwargs["response"])
+        else:
+            super().on_llm_error(error, **kwargs)
+
+
 def init_messages() -> None:
     clear_button = st.sidebar.button("Clear Chat", key="react_agent")
     if clear_button or "react_messages" not in st.session_state:
@@ -109,8 +134,11 @@ def agent_react():
 
         chat_history = [x[:2] for x in st.session_state.react_messages]
         with st.chat_message("assistant"):
-            st_callback = StreamlitCallbackHandler(
-                parent_container=st.container(),
+            thoughts_container = st.container()
+            answer_container = st.empty()
+            st_callback = AgentCallbackHandler(
+                answer_container=answer_container,
+                parent_container=thoughts_container,
                 expand_new_thoughts=True,
                 collapse_completed_thoughts=True,
             )
@@ -131,7 +159,7 @@ def agent_react():
             # for r in intermediate_steps:
             #     r[1] = r[1].replace("$", r"\$")
 
-            st.markdown(output)
+            answer_container.markdown(output)
 
             with st.expander("Sources"):
                 for _, content in intermediate_steps:
@@ -8,6 +8,8 @@ from langchain_openai import ChatOpenAI
 from src import CFG
 
 CHAT_MODELS = ["gemini-pro", "gpt-4-0613", "llama-2", "mistral", "llamacpp"]
+# serve.py serves every local model and routes requests by their `model` field
+SERVE_URL = f"http://{CFG.HOST}:{CFG.PORT.SERVE}"
 
 
 class GeminiPro:
@@ -41,10 +43,15 @@ class LocalChat:
         self.api_url = api_url
 
     def __call__(self, messages: list[ChatMessage], *args: Any, **kwds: Any) -> dict:
+        # kwds are passed on as generation parameters, e.g. stop, max_tokens, temperature
         response = requests.post(
             self.api_url + "/v1/chat/completions",
             headers={"Content-Type": "application/json"},
-            json={"messages": self._convert_langchainschema_to_dict(messages)},
+            json={
+                "model": self.model_name,
+                "messages": self._convert_langchainschema_to_dict(messages),
+                **kwds,
+            },
         )
         return response.json()["choices"][0]["message"]
 
@@ -104,9 +111,9 @@ def select_llm():
     if model_name.startswith("gpt-"):
         return ChatOpenAI(temperature=CFG.LLM_CONFIG.TEMPERATURE, model_name=model_name)
     if model_name == "llama-2":
-        return LocalChat(model_name, f"http://{CFG.HOST}:{CFG.PORT.LLAMA2}")
+        return LocalChat(CFG.LLAMA2.MODEL_NAME, SERVE_URL)
     if model_name == "mistral":
-        return LocalChat(model_name, f"http://{CFG.HOST}:{CFG.PORT.MISTRAL}")
+        return LocalChat(CFG.MISTRAL.MODEL_NAME, SERVE_URL)
     if model_name == "llamacpp":
         return LocalChatOpenAI("http://localhost:8000/v1")
     raise NotImplementedError
@@ -6,7 +6,7 @@ from langchain.schema import HumanMessage, AIMessage
 from src import CFG
 from streamlit_app import get_http_status
 
-API_URL = f"http://{CFG.HOST}:{CFG.PORT.CODELLAMA}"
+API_URL = f"http://{CFG.HOST}:{CFG.PORT.SERVE}"
 
 
 def init_messages() -> None:
@@ -17,9 +17,12 @@ def init_messages() -> None:
 
 def get_answer(user_input: str) -> str:
     response = requests.post(
-        API_URL,
+        API_URL + "/v1/chat/completions",
         headers={"Content-Type": "application/json"},
-        json={"messages": [{"role": "user", "content": user_input}]},
+        json={
+            "model": CFG.CODELLAMA.MODEL_NAME,
+            "messages": [{"role": "user", "content": user_input}],
+        },
     )
     return response.json()["choices"][0]["message"]["content"]
 
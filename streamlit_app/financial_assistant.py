@@ -10,10 +10,20 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langchain_community.document_loaders import PyMuPDFLoader
 from langchain_community.vectorstores.faiss import FAISS
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_openai import OpenAIEmbeddings
+
+from src import CFG
 
 LLM = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.0, max_retries=2)
-EMBEDDINGS = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+# Local /v1/embeddings endpoint of serve.py, which batches and caches the chunks
+EMBEDDINGS = OpenAIEmbeddings(
+    model=CFG.EMBEDDINGS.MODEL_NAME,
+    base_url=f"http://{CFG.HOST}:{CFG.PORT.SERVE}/v1",
+    api_key="local",
+    # send texts rather than tiktoken ids, which only OpenAI models understand
+    check_embedding_ctx_length=False,
+)
 
 METRICS = [
     "net property income",
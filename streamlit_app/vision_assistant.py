@@ -1,10 +1,12 @@
-import base64
+import json
+
 import requests
 
 import streamlit as st
 from langchain.schema import HumanMessage, AIMessage
 
 from src import CFG
+from src.general import encode_image_url
 from streamlit_app import get_http_status
 from streamlit_app.utils import set_container_width
 
@@ -12,6 +14,14 @@ API_URL = f"http://{CFG.HOST}:{CFG.PORT.LLAVA}"
 
 # sliding window of the most recent interactions
 MEMORY_BUFFER_WINDOW = 6
+# input size of the CLIP projector of LLaVA 1.5
+IMAGE_SIZE = 336
+
+
+@st.cache_data
+def get_image_url(image_bytes: bytes) -> str:
+    """Downscales the upload once, instead of sending the full image every turn."""
+    return encode_image_url(image_bytes, max_size=IMAGE_SIZE)
 
 
 def init_sess_state() -> None:
@@ -39,10 +49,26 @@ def buffer_window_memory(messages: list) -> list:
     return messages[:3] + messages[3:][-MEMORY_BUFFER_WINDOW:]
 
 
-def get_output(messages: list) -> str:
+def stream_output(messages: list):
+    """Yields the tokens of the response as the server streams them. Raises RuntimeError
+    if generation fails or the stream ends before `[DONE]`."""
     headers = {"Content-Type": "application/json"}
-    response = requests.post(API_URL, headers=headers, json={"inputs": messages})
-    return response.json()["choices"][0]["message"]
+    with requests.post(
+        API_URL, headers=headers, json={"inputs": messages, "stream": True}, stream=True
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line == b"data: [DONE]":
+                return
+            if not line.startswith(b"data: "):
+                continue
+            data = json.loads(line[len(b"data: "):])
+            if "error" in data:
+                raise RuntimeError(f"Generation failed: {data['error']['message']}")
+            delta = data["choices"][0]["delta"]
+            if delta.get("content"):
+                yield delta["content"]
+    raise RuntimeError("The response ended before it was complete")
 
 
 def vision_assistant():
@@ -68,7 +94,7 @@ def vision_assistant():
     c0.image(_img_bytes)
     st.session_state.image_bytes = _img_bytes
 
-    img_b64 = base64.b64encode(_img_bytes.getvalue()).decode("utf-8")
+    image_url = get_image_url(_img_bytes.getvalue())
 
     with c1:
         # Display chat history
@@ -90,7 +116,7 @@ def vision_assistant():
                 "content": [
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"},
+                        "image_url": {"url": image_url},
                     },
                     {"type": "text", "text": user_input},
                 ],
@@ -103,9 +129,15 @@ def vision_assistant():
         st.session_state.chv_messages.append(HumanMessage(content=user_input))
 
         with c1.chat_message("assistant"):
-            with st.spinner("Thinking ..."):
-                message = get_output(st.session_state.llava_messages)
-            st.markdown(message["content"])
+            try:
+                content = st.write_stream(stream_output(st.session_state.llava_messages))
+            except (requests.RequestException, RuntimeError) as e:
+                st.error(e)
+                # drop the unanswered question, so that it can be asked again
+                st.session_state.llava_messages.pop()
+                st.session_state.chv_messages.pop()
+                return
+        message = {"role": "assistant", "content": content}
 
         st.session_state.llava_messages.append(message)
         st.session_state.chv_messages.append(AIMessage(content=message["content"]))